@@ -4,133 +4,176 @@ Assemble vertical YouTube Shorts with karaoke-style subtitles.
 Multiple AI images + Ken Burns effects + big bold word-by-word captions.
 """
 
+import functools
 import os
 import subprocess
 import sys
 import re
 
+from audio_utils import mp3_duration
+from ffmpeg_utils import FFMPEG, FFPROBE, filter_complex_args, h264_args
+
 WIDTH = 1080
 HEIGHT = 1920
 FPS = 30
 FONT_PATH = "/usr/share/fonts/truetype/msttcorefonts/Arial_Bold.ttf"
+FONTS_DIR = os.path.dirname(FONT_PATH)
+FONT_NAME = "Arial"
 OUTPUT_DIR = "/pipeline/output"
+# ffmpeg -threads for a standalone encode; "0" lets libx264 use every core.
+# Callers running several assemblies side by side pass threads="1".
+ENCODE_THREADS = os.environ.get("ENCODE_THREADS", "0")
 SHORTS_DIR = "/pipeline/output/shorts"
 
 EFFECTS = ["zoom_in", "zoom_out", "pan_down", "pan_up"]
 
+# VTT cue markup like <c> or <00:00:01.000>
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Single-pass escape tables (str.translate) for filter and subtitle text
+_DRAWTEXT_ESCAPES = str.maketrans({
+    "\\": "\\\\\\\\",
+    "'": "\u2019",
+    '"': '\\"',
+    ":": "\\\\:",
+    "%": "%%%%",
+    "[": "\\\\[",
+    "]": "\\\\]",
+    ";": "\\\\;",
+})
+_ASS_ESCAPES = str.maketrans({"\\": "", "{": "(", "}": ")"})
+
+
+def parse_vtt_words(vtt_path: str) -> tuple:
+    """Parse VTT file into (start_ms, end_ms, word) tuples, spreading each cue's time over its words.
+
+    Results are memoized per file version (path, mtime, size); the returned
+    tuple is shared, not copied.
+    """
+    if not vtt_path:
+        return ()
+    try:
+        st = os.stat(vtt_path)
+    except OSError:
+        return ()
+    return _parse_vtt_cached(vtt_path, st.st_mtime_ns, st.st_size)
+
 
-def parse_vtt_words(vtt_path: str) -> list:
-    """Parse VTT file and split sentences into individual words with distributed timing."""
+@functools.lru_cache(maxsize=64)
+def _parse_vtt_cached(vtt_path: str, mtime_ns: int, size: int) -> tuple:
+    """Parse one VTT file version in a single pass (mtime_ns/size only key the cache)."""
     words = []
-    if not vtt_path or not os.path.exists(vtt_path):
-        return words
+    cue_start = None
+    cue_end = None
 
     with open(vtt_path) as f:
-        content = f.read()
-
-    cues = []
-    current_start = None
-    current_end = None
-
-    for line in content.split("\n"):
-        line = line.strip()
-        if "-->" in line:
-            parts = line.split(" --> ")
-            if len(parts) == 2:
-                current_start = _parse_time(parts[0])
-                current_end = _parse_time(parts[1])
-        elif line and line != "WEBVTT" and not line.startswith("NOTE") and not line.isdigit():
-            if current_start is not None:
-                text = re.sub(r'<[^>]+>', '', line)
-                if text.strip():
-                    cues.append({
-                        "text": text.strip(),
-                        "start": current_start,
-                        "end": current_end,
-                    })
-                current_start = None
-                current_end = None
-
-    for cue in cues:
-        cue_words = cue["text"].split()
-        if not cue_words:
-            continue
-        cue_duration = cue["end"] - cue["start"]
-        word_duration = cue_duration / len(cue_words)
-
-        for j, word in enumerate(cue_words):
-            words.append({
-                "text": word,
-                "start": cue["start"] + j * word_duration,
-                "end": cue["start"] + (j + 1) * word_duration,
-            })
-
-    return words
-
-
-def _parse_time(time_str: str) -> float:
-    """Parse VTT timestamp to seconds."""
-    time_str = time_str.strip().replace(",", ".")
-    parts = time_str.split(":")
-    if len(parts) == 3:
-        h, m, s = parts
-        return int(h) * 3600 + int(m) * 60 + float(s)
-    elif len(parts) == 2:
-        m, s = parts
-        return int(m) * 60 + float(s)
-    return 0
-
-
-def group_words(words: list, max_words: int = 3) -> list:
-    """Group words into chunks for display."""
-    groups = []
+        for line in f:
+            line = line.strip()
+            if "-->" in line:
+                parts = line.split(" --> ")
+                if len(parts) == 2:
+                    cue_start = _parse_time_ms(parts[0])
+                    cue_end = _parse_time_ms(parts[1])
+            elif line and line != "WEBVTT" and not line.startswith("NOTE") and not line.isdigit():
+                if cue_start is not None:
+                    tokens = _TAG_RE.sub('', line).split()
+                    if tokens:
+                        # Integer split of the cue: word boundaries land on whole
+                        # milliseconds and the last word ends exactly at cue_end
+                        span, n = cue_end - cue_start, len(tokens)
+                        words.extend(
+                            (cue_start + span * j // n, cue_start + span * (j + 1) // n, token)
+                            for j, token in enumerate(tokens)
+                        )
+                    cue_start = None
+                    cue_end = None
+
+    return tuple(words)
+
+
+def _parse_time_ms(time_str: str) -> int:
+    """Parse VTT timestamp to integer milliseconds."""
+    hms, _, frac = time_str.strip().replace(",", ".").partition(".")
+    parts = hms.split(":")
+    try:
+        if len(parts) == 3:
+            seconds = (int(parts[0]) * 60 + int(parts[1])) * 60 + int(parts[2])
+        elif len(parts) == 2:
+            seconds = int(parts[0]) * 60 + int(parts[1])
+        else:
+            return 0
+        return seconds * 1000 + int((frac + "000")[:3])
+    except ValueError:
+        return 0
+
+
+def iter_subtitle_events(words, max_words: int = 3):
+    """Yield (start, end, text) for each display group of up to max_words words."""
     for i in range(0, len(words), max_words):
         chunk = words[i:i + max_words]
-        if chunk:
-            groups.append({
-                "text": " ".join(w["text"] for w in chunk),
-                "start": chunk[0]["start"],
-                "end": chunk[-1]["end"],
-            })
-    return groups
+        yield chunk[0][0], chunk[-1][1], " ".join(w[2] for w in chunk)
 
 
 def escape_drawtext(text: str) -> str:
     """Escape text for FFmpeg drawtext filter."""
-    text = text.replace("\\", "\\\\\\\\")
-    text = text.replace("'", "\u2019")
-    text = text.replace('"', '\\"')
-    text = text.replace(":", "\\\\:")
-    text = text.replace("%", "%%%%")
-    text = text.replace("[", "\\\\[")
-    text = text.replace("]", "\\\\]")
-    text = text.replace(";", "\\\\;")
-    return text
-
-
-def build_subtitle_filter(vtt_path: str) -> str:
-    """Build FFmpeg drawtext filter chain for cinematic subtitles."""
-    words = parse_vtt_words(vtt_path)
-    if not words:
-        return ""
+    return text.translate(_DRAWTEXT_ESCAPES)
 
-    groups = group_words(words, max_words=3)
-    if not groups:
-        return ""
 
-    # Lower third positioning (like pro reels)
+def _format_ass_time(ms: int) -> str:
+    """Format integer milliseconds as an ASS timestamp (H:MM:SS.cc)."""
+    cs = (ms + 5) // 10
+    h, cs = divmod(cs, 360000)
+    m, cs = divmod(cs, 6000)
+    s, cs = divmod(cs, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+
+def escape_ass(text: str) -> str:
+    """Strip characters libass would treat as override/escape sequences."""
+    return text.translate(_ASS_ESCAPES)
+
+
+def build_ass_subtitle_file(words: list, ass_path: str) -> bool:
+    """Write cinematic karaoke subtitles as an ASS file for a single subtitles= filter.
+
+    One libass renderer replaces the old chain of one drawtext per word group,
+    which FFmpeg had to evaluate on every frame.
+    """
+    if not words:
+        return False
+
+    # Lower third positioning (like pro reels). Top-center alignment (8) makes
+    # MarginV the same y offset the drawtext version used.
     y_pos = int(HEIGHT * 0.68)
 
-    filters = []
-    for g in groups:
-        text = escape_drawtext(g["text"].upper())
-        start = g["start"]
-        end = g["end"]
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {WIDTH}",
+        f"PlayResY: {HEIGHT}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, "
+        "BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, "
+        "BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
+        # Colours are &HAABBGGRR: white text, black@0.8 border, black@0.5 shadow
+        f"Style: Default,{FONT_NAME},72,&H00FFFFFF,&H00FFFFFF,&H33000000,&H80000000,"
+        f"-1,0,0,0,100,100,0,0,1,4,2,8,20,20,{y_pos},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+
+    # Groups are formatted straight from the word tuples, no intermediate list
+    for start, end, raw in iter_subtitle_events(words, max_words=3):
+        text = escape_ass(raw.upper())
         if not text.strip():
             continue
 
         # Scale font down for longer text to prevent overflow
-        raw_len = len(g["text"])
+        raw_len = len(raw)
         if raw_len > 18:
             fsize = 58
         elif raw_len > 14:
@@ -138,22 +181,25 @@ def build_subtitle_filter(vtt_path: str) -> str:
         else:
             fsize = 72
 
-        f = (
-            f"drawtext=text='{text}'"
-            f":fontfile={FONT_PATH}"
-            f":fontsize={fsize}"
-            f":fontcolor=white"
-            f":borderw=4"
-            f":bordercolor=black@0.8"
-            f":shadowcolor=black@0.5"
-            f":shadowx=2:shadowy=2"
-            f":x=(w-text_w)/2"
-            f":y={y_pos}"
-            f":enable='between(t\\,{start:.3f}\\,{end:.3f})'"
+        lines.append(
+            f"Dialogue: 0,{_format_ass_time(start)},{_format_ass_time(end)},"
+            f"Default,,0,0,0,,{{\\fs{fsize}}}{text}"
         )
-        filters.append(f)
 
-    return ",".join(filters)
+    try:
+        with open(ass_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return True
+    except OSError as e:
+        print(f"    [WARN] Could not write subtitles: {e}", file=sys.stderr)
+        return False
+
+
+def build_subtitle_filter(ass_path: str) -> str:
+    """Build the subtitles= filter that burns in an ASS file."""
+    if not ass_path:
+        return ""
+    return f"subtitles='{ass_path}':fontsdir='{FONTS_DIR}'"
 
 
 def build_hook_filter(hook_text: str, duration: float = 2.5) -> str:
@@ -173,21 +219,47 @@ def build_hook_filter(hook_text: str, duration: float = 2.5) -> str:
         f":shadowx=2:shadowy=2"
         f":x=(w-text_w)/2"
         f":y={int(HEIGHT * 0.28)}"
-        f":enable='between(t\\,0.2\\,{duration})'"
+        f":enable='lte(t\\,{duration})*gte(t\\,0.2)'"
     )
 
 
+# Durations keyed by (path, mtime, size) so a rewritten file is re-probed
+_DUR_CACHE: dict = {}
+
+
 def get_duration(filepath: str) -> float:
-    """Get media file duration."""
+    """Get media file duration (cached per file version)."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return 0
+    key = (filepath, st.st_mtime_ns, st.st_size)
+    if key in _DUR_CACHE:
+        return _DUR_CACHE[key]
+    # Narration is MP3, whose length is in its headers; no need for ffprobe
+    duration = mp3_duration(filepath) if filepath.endswith(".mp3") else None
+    if duration is not None:
+        _DUR_CACHE[key] = duration
+        return duration
     try:
         result = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
+            [FFPROBE, "-v", "quiet", "-show_entries", "format=duration",
              "-of", "csv=p=0", filepath],
             capture_output=True, text=True, timeout=30
         )
-        return float(result.stdout.strip())
+        duration = float(result.stdout.strip())
     except (ValueError, subprocess.TimeoutExpired):
         return 0
+    _DUR_CACHE[key] = duration
+    return duration
+
+
+def _size_or_zero(path: str) -> int:
+    """File size in bytes, or 0 if it doesn't exist (one stat call)."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
 
 
 def _zoompan_expr(effect: str, frames: int) -> str:
@@ -203,64 +275,19 @@ def _zoompan_expr(effect: str, frames: int) -> str:
         return f"zoompan=z='1.12':x='iw/2-(iw/zoom/2)':y='if(eq(on\\,1)\\,ih-ih/zoom\\,max(y-1\\,0))'{base}"
 
 
-def _create_bg_video(image_paths: list, duration: float, output_path: str) -> bool:
-    """Create background video from multiple images (static + concat, fast on ARM)."""
-    n = len(image_paths)
-    seg_dur = duration / n
-
-    cmd = ["ffmpeg", "-y"]
-
-    # Add each image as a looped input
-    for img in image_paths:
-        cmd.extend(["-loop", "1", "-t", f"{seg_dur:.2f}", "-framerate", str(FPS), "-i", img])
-
-    # Scale + pad each to vertical, then concat (no zoompan = fast on ARM)
-    filter_parts = []
-    concat_inputs = ""
-
-    for i in range(n):
-        filter_parts.append(
-            f"[{i}:v]scale={WIDTH}:{HEIGHT}:force_original_aspect_ratio=decrease,"
-            f"pad={WIDTH}:{HEIGHT}:(ow-iw)/2:(oh-ih)/2:color=black,"
-            f"setsar=1,fps={FPS}[v{i}]"
-        )
-        concat_inputs += f"[v{i}]"
-
-    filter_parts.append(f"{concat_inputs}concat=n={n}:v=1:a=0[vout]")
-    filter_complex = ";".join(filter_parts)
-
-    cmd.extend([
-        "-filter_complex", filter_complex,
-        "-map", "[vout]",
-        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "26",
-        "-pix_fmt", "yuv420p",
-        "-threads", "1",
-        output_path,
-    ])
-
-    try:
-        result = subprocess.run(cmd, capture_output=True, timeout=300, text=True)
-        if result.returncode != 0:
-            print(f"    [ERR] BG video: {result.stderr[-300:]}", file=sys.stderr)
-            return False
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 10000
-    except Exception as e:
-        print(f"    [ERR] BG video failed: {e}", file=sys.stderr)
-        return False
-
-
 def assemble_short(image_paths, audio_path: str, vtt_path: str,
                    output_path: str, hook_text: str = "",
-                   duration: float = None) -> bool:
+                   duration: float = None, threads: str = ENCODE_THREADS) -> bool:
     """Assemble a YouTube Short from images + audio + karaoke subtitles.
 
     image_paths: single path (str) or list of paths for multi-image.
+    threads: ffmpeg -threads value for the encode.
     """
     if isinstance(image_paths, str):
         image_paths = [image_paths]
 
     # Filter to only existing images
-    image_paths = [p for p in image_paths if os.path.exists(p) and os.path.getsize(p) > 5000]
+    image_paths = [p for p in image_paths if _size_or_zero(p) > 5000]
     if not image_paths:
         print("    [ERR] No valid images", file=sys.stderr)
         return False
@@ -272,15 +299,28 @@ def assemble_short(image_paths, audio_path: str, vtt_path: str,
 
     duration = min(duration + 0.5, 59)
 
-    if len(image_paths) == 1:
-        return _assemble_single(image_paths[0], audio_path, vtt_path,
-                                output_path, hook_text, duration)
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+    ass_path = os.path.join(os.path.dirname(output_path), f"_subs_{stem}.ass")
+    if not build_ass_subtitle_file(parse_vtt_words(vtt_path), ass_path):
+        ass_path = None
+
+    try:
+        if len(image_paths) == 1:
+            return _assemble_single(image_paths[0], audio_path, ass_path,
+                                    output_path, hook_text, duration, threads)
 
-    return _assemble_multi(image_paths, audio_path, vtt_path,
-                           output_path, hook_text, duration)
+        return _assemble_multi(image_paths, audio_path, ass_path,
+                               output_path, hook_text, duration, threads)
+    finally:
+        if ass_path:
+            try:
+                os.remove(ass_path)
+            except OSError:
+                pass
 
 
-def _assemble_single(image_path, audio_path, vtt_path, output_path, hook_text, duration):
+def _assemble_single(image_path, audio_path, ass_path, output_path, hook_text, duration,
+                     threads=ENCODE_THREADS):
     """Single image assembly."""
     zoompan = (
         f"zoompan=z='min(zoom+0.0005\\,1.12)'"
@@ -291,7 +331,7 @@ def _assemble_single(image_path, audio_path, vtt_path, output_path, hook_text, d
         f":fps={FPS}"
     )
 
-    subtitle_filter = build_subtitle_filter(vtt_path)
+    subtitle_filter = build_subtitle_filter(ass_path)
     hook_filter = build_hook_filter(hook_text)
 
     vf_parts = [zoompan]
@@ -303,17 +343,17 @@ def _assemble_single(image_path, audio_path, vtt_path, output_path, hook_text, d
     vf = ",".join(vf_parts)
 
     cmd = [
-        "ffmpeg", "-y",
+        FFMPEG, "-y",
         "-loop", "1", "-i", image_path,
         "-i", audio_path,
         "-vf", vf,
         "-t", str(duration),
         "-map", "0:v", "-map", "1:a",
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
+        *h264_args("fast", 23),
         "-c:a", "aac", "-b:a", "128k",
         "-pix_fmt", "yuv420p",
         "-shortest",
-        "-threads", "1",
+        "-threads", threads,
         output_path,
     ]
 
@@ -322,69 +362,84 @@ def _assemble_single(image_path, audio_path, vtt_path, output_path, hook_text, d
         if result.returncode != 0:
             print(f"    [ERR] FFmpeg: {result.stderr[-200:]}", file=sys.stderr)
             return False
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 10000
+        return _size_or_zero(output_path) > 10000
     except Exception as e:
         print(f"    [ERR] Assembly failed: {e}", file=sys.stderr)
         return False
 
 
-def _assemble_multi(image_paths, audio_path, vtt_path, output_path, hook_text, duration):
-    """Multi-image assembly: Ken Burns per image, concat, then overlay subtitles + audio."""
+def _assemble_multi(image_paths, audio_path, ass_path, output_path, hook_text, duration,
+                    threads=ENCODE_THREADS):
+    """Multi-image assembly in one pass: scale + concat images, overlay subtitles + audio.
 
-    work_dir = os.path.dirname(output_path)
-    bg_path = os.path.join(work_dir, f"_bg_{os.path.basename(output_path)}")
+    Background and overlays share a single filter graph so the short is
+    decoded and encoded once, with no intermediate background file.
+    """
+    n = len(image_paths)
+    seg_dur = duration / n
 
-    print(f"    Creating background from {len(image_paths)} images...", file=sys.stderr)
+    print(f"    Compositing {n} images...", file=sys.stderr)
 
-    if not _create_bg_video(image_paths, duration, bg_path):
-        print("    [WARN] Multi-image failed, falling back to first image", file=sys.stderr)
-        return _assemble_single(image_paths[0], audio_path, vtt_path,
-                                output_path, hook_text, duration)
+    cmd = [FFMPEG, "-y"]
 
-    # Step 2: Overlay audio + subtitles on background video
-    subtitle_filter = build_subtitle_filter(vtt_path)
-    hook_filter = build_hook_filter(hook_text)
+    # Add each image as a looped input, audio goes last (input index n)
+    for img in image_paths:
+        cmd.extend(["-loop", "1", "-t", f"{seg_dur:.2f}", "-framerate", str(FPS), "-i", img])
+    cmd.extend(["-i", audio_path])
 
-    vf_parts = []
+    # Scale + pad each to vertical, then concat (no zoompan = fast on ARM)
+    # format right after scale lets swscale convert RGB/YUVJ images to yuv420p
+    # in the same pass, so pad and everything downstream run on the encoder's
+    # format. setsar=1 stays because concat needs uniform SAR.
+    filter_parts = [
+        f"[{i}:v]scale={WIDTH}:{HEIGHT}:force_original_aspect_ratio=decrease,format=yuv420p,"
+        f"pad={WIDTH}:{HEIGHT}:(ow-iw)/2:(oh-ih)/2:color=black,"
+        f"setsar=1,fps={FPS}[v{i}]"
+        for i in range(n)
+    ]
+    concat_inputs = "".join(f"[v{i}]" for i in range(n))
+
+    overlay_parts = []
+    subtitle_filter = build_subtitle_filter(ass_path)
     if subtitle_filter:
-        vf_parts.append(subtitle_filter)
+        overlay_parts.append(subtitle_filter)
+    hook_filter = build_hook_filter(hook_text)
     if hook_filter:
-        vf_parts.append(hook_filter)
-
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", bg_path,
-        "-i", audio_path,
-    ]
+        overlay_parts.append(hook_filter)
 
-    if vf_parts:
-        cmd.extend(["-vf", ",".join(vf_parts)])
+    if overlay_parts:
+        filter_parts.append(f"{concat_inputs}concat=n={n}:v=1:a=0[bg]")
+        filter_parts.append(f"[bg]{','.join(overlay_parts)}[vout]")
+    else:
+        filter_parts.append(f"{concat_inputs}concat=n={n}:v=1:a=0[vout]")
 
+    graph_args, graph_file = filter_complex_args(";".join(filter_parts))
+    cmd.extend(graph_args)
     cmd.extend([
         "-t", str(duration),
-        "-map", "0:v", "-map", "1:a",
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
+        "-map", "[vout]", "-map", f"{n}:a",
+        *h264_args("fast", 23),
         "-c:a", "aac", "-b:a", "128k",
         "-pix_fmt", "yuv420p",
         "-shortest",
-        "-threads", "1",
+        "-threads", threads,
         output_path,
     ])
 
     try:
         result = subprocess.run(cmd, capture_output=True, timeout=300, text=True)
-        if result.returncode != 0:
-            print(f"    [ERR] FFmpeg overlay: {result.stderr[-200:]}", file=sys.stderr)
-            return False
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 10000
+        if result.returncode == 0 and _size_or_zero(output_path) > 10000:
+            return True
+        print(f"    [ERR] FFmpeg multi-image: {result.stderr[-300:]}", file=sys.stderr)
     except Exception as e:
-        print(f"    [ERR] Overlay failed: {e}", file=sys.stderr)
-        return False
+        print(f"    [ERR] Multi-image assembly failed: {e}", file=sys.stderr)
     finally:
-        try:
-            os.remove(bg_path)
-        except OSError:
-            pass
+        if graph_file:
+            os.remove(graph_file)
+
+    print("    [WARN] Multi-image failed, falling back to first image", file=sys.stderr)
+    return _assemble_single(image_paths[0], audio_path, ass_path,
+                            output_path, hook_text, duration, threads)
 
 
 if __name__ == "__main__":
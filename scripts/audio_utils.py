@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Read MP3 durations straight from the file headers.
+
+Knowing the length of an edge-tts clip shouldn't cost an ffprobe process.
+mp3_duration() skips any ID3v2 tag and reads the first MPEG audio frame
+header. It prefers the Xing/Info or VBRI frame count when one is present,
+and otherwise assumes constant bitrate. It returns None for anything it
+doesn't understand, so callers can fall back to ffprobe.
+"""
+
+import os
+
+# Layer III bitrates in kbps, indexed by the header's 4-bit bitrate field
+_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+_SAMPLE_RATES_V1 = (44100, 48000, 32000)
+
+HEADER_SCAN_BYTES = 64 * 1024  # how far past the ID3 tag to look for the first frame
+
+
+def _parse_frame_header(b: bytes):
+    """(kbps, sample_rate, samples_per_frame, frame_len, mono, mpeg1) or None."""
+    if len(b) < 4 or b[0] != 0xFF or b[1] & 0xE0 != 0xE0:
+        return None
+    version = (b[1] >> 3) & 3   # 0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1
+    layer = (b[1] >> 1) & 3     # 1 = Layer III
+    bitrate_idx = b[2] >> 4
+    rate_idx = (b[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+
+    mpeg1 = version == 3
+    kbps = (_BITRATES_V1 if mpeg1 else _BITRATES_V2)[bitrate_idx]
+    sample_rate = _SAMPLE_RATES_V1[rate_idx] >> (0 if mpeg1 else 1 if version == 2 else 2)
+    samples = 1152 if mpeg1 else 576
+    padding = (b[2] >> 1) & 1
+    frame_len = samples // 8 * kbps * 1000 // sample_rate + padding
+    mono = (b[3] >> 6) == 3
+    return kbps, sample_rate, samples, frame_len, mono, mpeg1
+
+
+def mp3_duration(filepath: str) -> float | None:
+    """Duration in seconds from the MP3 headers, or None if they can't be read."""
+    try:
+        size = os.path.getsize(filepath)
+        with open(filepath, "rb") as f:
+            head = f.read(10)
+            start = 0
+            if head[:3] == b"ID3" and len(head) == 10:
+                # Synchsafe size: 7 bits per byte, plus 10 for the footer if flagged
+                start = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+                if head[5] & 0x10:
+                    start += 10
+            f.seek(start)
+            buf = f.read(HEADER_SCAN_BYTES)
+            f.seek(max(0, size - 128))
+            has_id3v1 = size - start >= 128 and f.read(3) == b"TAG"
+    except OSError:
+        return None
+
+    # First frame sync whose successor (if in the buffer) is also a frame,
+    # so a stray 0xFF in leftover tag data isn't taken as audio
+    pos = buf.find(b"\xff")
+    while pos != -1:
+        header = _parse_frame_header(buf[pos:pos + 4])
+        if header:
+            nxt = pos + header[3]
+            if nxt + 4 > len(buf) or _parse_frame_header(buf[nxt:nxt + 4]):
+                break
+        pos = buf.find(b"\xff", pos + 1)
+    if pos == -1:
+        return None
+
+    kbps, sample_rate, samples, _, mono, mpeg1 = header
+
+    # Xing/Info sits after the side info; VBRI at a fixed 32-byte offset
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = pos + 4 + side_info
+    if buf[xing:xing + 4] in (b"Xing", b"Info") and len(buf) >= xing + 12 and buf[xing + 7] & 1:
+        frames = int.from_bytes(buf[xing + 8:xing + 12], "big")
+        return frames * samples / sample_rate
+    vbri = pos + 4 + 32
+    if buf[vbri:vbri + 4] == b"VBRI" and len(buf) >= vbri + 18:
+        frames = int.from_bytes(buf[vbri + 14:vbri + 18], "big")
+        return frames * samples / sample_rate
+
+    audio_bytes = size - start - pos - (128 if has_id3v1 else 0)
+    return audio_bytes * 8 / (kbps * 1000)
@@ -10,15 +10,18 @@ import json
 import os
 import subprocess
 import sys
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from ffmpeg_utils import FFMPEG, FFPROBE, filter_complex_args, h264_args, hwaccel_args
+
 BASE_DIR = "/pipeline"
 CLIPS_DIR = f"{BASE_DIR}/clips"
 AUDIO_DIR = f"{BASE_DIR}/audio"
 OUTPUT_DIR = f"{BASE_DIR}/output"
 SHORTS_DIR = f"{BASE_DIR}/output/shorts"
 MUSIC_DIR = f"{BASE_DIR}/templates/music"
+MUSIC_VOLUME = 0.08  # Background music level under narration
 
 # Video settings
 WIDTH = 1920
@@ -26,26 +29,70 @@ HEIGHT = 1080
 FPS = 30
 CRF = 23  # Quality (lower = better, 18-28 typical)
 PRESET = "fast"  # Speed vs compression tradeoff
+# ffmpeg -threads for standalone encodes ("0" = all cores). The compilation
+# always runs alone; shorts rendered side by side in generate_shorts stay
+# single-threaded, and a lone short gets the whole machine.
+ENCODE_THREADS = os.environ.get("ENCODE_THREADS", "0")
+
+# Every compilation segment's audio is resampled to this before concat
+AUDIO_NORMALIZE = "aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo"
 
 # Shorts settings
 SHORTS_WIDTH = 1080
 SHORTS_HEIGHT = 1920
+SHORTS_MAX_SECONDS = 60
 
 
-def get_duration(filepath: str) -> float:
-    """Get media file duration."""
+# Probe results keyed by (path, mtime, size) so a rewritten file is re-probed
+_PROBE_CACHE: dict = {}
+
+
+def probe_media(filepath: str) -> dict:
+    """Probe duration and stream types with one ffprobe JSON call (cached)."""
+    st = os.stat(filepath)
+    key = (filepath, st.st_mtime_ns, st.st_size)
+    cached = _PROBE_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     result = subprocess.run(
-        ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-         "-of", "csv=p=0", filepath],
+        [FFPROBE, "-v", "quiet", "-print_format", "json",
+         "-show_entries", "format=duration:stream=codec_type", filepath],
         capture_output=True, text=True, timeout=30
     )
-    return float(result.stdout.strip())
+    data = json.loads(result.stdout or "{}")
+    duration = data.get("format", {}).get("duration")
+    streams = data.get("streams", [])
+    info = {
+        "duration": float(duration) if duration else None,
+        "has_audio": any(stream.get("codec_type") == "audio" for stream in streams),
+    }
+    if result.returncode == 0:
+        _PROBE_CACHE[key] = info
+    return info
+
+
+def probe_many(paths: list) -> None:
+    """Warm the probe cache for several files in parallel (ffprobe is spawn-bound)."""
+    paths = [p for p in set(paths) if p and os.path.exists(p)]
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(probe_media, paths))
+
+
+def get_duration(filepath: str) -> float:
+    """Get media file duration."""
+    duration = probe_media(filepath)["duration"]
+    if duration is None:
+        raise ValueError(f"Could not read duration of {filepath}")
+    return duration
 
 
 def get_video_dimensions(filepath: str) -> tuple:
     """Get video width and height."""
     result = subprocess.run(
-        ["ffprobe", "-v", "quiet", "-select_streams", "v:0",
+        [FFPROBE, "-v", "quiet", "-select_streams", "v:0",
          "-show_entries", "stream=width,height", "-of", "csv=p=0", filepath],
         capture_output=True, text=True, timeout=30
     )
@@ -53,133 +100,94 @@ def get_video_dimensions(filepath: str) -> tuple:
     return int(parts[0]), int(parts[1])
 
 
-def scale_and_pad(input_path: str, output_path: str, target_w: int, target_h: int):
-    """Scale video to fit target dimensions with padding (letterbox/pillarbox)."""
-    cmd = [
-        "ffmpeg", "-y", "-i", input_path,
-        "-vf", (
-            f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,"
-            f"pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:color=black,"
-            f"setsar=1"
-        ),
-        "-c:v", "libx264", "-preset", PRESET, "-crf", str(CRF),
-        "-c:a", "aac", "-b:a", "128k",
-        "-r", str(FPS),
-        "-threads", "1",
-        output_path,
-    ]
-    subprocess.run(cmd, capture_output=True, timeout=300, check=True)
+def has_audio_stream(filepath: str) -> bool:
+    """Check whether a media file has at least one audio stream."""
+    return probe_media(filepath)["has_audio"]
 
 
-def create_text_video(text: str, duration: float, output_path: str,
-                      w: int = WIDTH, h: int = HEIGHT, fontsize: int = 48):
-    """Create a video with text on black background."""
-    cmd = [
-        "ffmpeg", "-y",
-        "-f", "lavfi", "-i", f"color=c=black:s={w}x{h}:d={duration}:r={FPS}",
-        "-f", "lavfi", "-i", f"anullsrc=r=44100:cl=stereo",
-    ]
+def _escape_text(text: str) -> str:
+    """Escape text for an inline drawtext filter."""
+    return text.replace("'", "\\'").replace(":", "\\:")
+
+
+def _narration_segment(k: int, duration: float, text: str = "",
+                       fontsize: int = 48) -> list:
+    """Filters for narration input k: black (optionally titled) screen + voice.
+
+    The color source is already square-pixel, so only the pixel format needs
+    pinning for concat.
+    """
+    video = f"color=c=black:s={WIDTH}x{HEIGHT}:d={duration:.3f}:r={FPS}"
     # Only add drawtext if there's actual text
     if text.strip():
-        safe_text = text.replace("'", "\\'").replace(":", "\\:")
-        cmd.extend(["-vf", (
-            f"drawtext=text='{safe_text}'"
+        video += (
+            f",drawtext=text='{_escape_text(text)}'"
             f":fontsize={fontsize}:fontcolor=white"
             f":x=(w-text_w)/2:y=(h-text_h)/2"
             f":font=Sans"
-        )])
-    cmd.extend([
-        "-t", str(duration),
-        "-c:v", "libx264", "-preset", PRESET,
-        "-c:a", "aac",
-        "-shortest",
-        output_path,
-    ])
-    subprocess.run(cmd, capture_output=True, timeout=120, check=True)
-
-
-def concat_videos(file_list: list, output_path: str):
-    """Concatenate videos using FFmpeg concat demuxer."""
-    list_file = output_path + ".txt"
-    with open(list_file, "w") as f:
-        for filepath in file_list:
-            f.write(f"file '{filepath}'\n")
-
-    cmd = [
-        "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-        "-i", list_file,
-        "-c", "copy",
-        "-movflags", "+faststart",
-        output_path,
+        )
+    return [
+        f"{video},format=yuv420p[v{k}]",
+        f"[{k}:a]{AUDIO_NORMALIZE}[a{k}]",
     ]
-    subprocess.run(cmd, capture_output=True, timeout=300, check=True)
-    os.remove(list_file)
 
 
-def add_background_music(video_path: str, music_path: str, output_path: str,
-                         music_volume: float = 0.08):
-    """Mix background music into video at low volume."""
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", video_path,
-        "-i", music_path,
-        "-filter_complex", (
-            f"[1:a]aloop=loop=-1:size=2e+09,volume={music_volume}[music];"
-            f"[0:a][music]amix=inputs=2:duration=first:dropout_transition=3[out]"
-        ),
-        "-map", "0:v", "-map", "[out]",
-        "-c:v", "copy",
-        "-c:a", "aac", "-b:a", "192k",
-        "-shortest",
-        output_path,
+def _clip_segment(k: int, clip_path: str) -> list:
+    """Filters for clip input k, normalized to the compilation format.
+
+    The pixel format is converted inside the scale pass; setsar=1 is kept since
+    downloaded clips can carry non-square SAR and concat needs it uniform.
+    """
+    filters = [
+        f"[{k}:v]scale={WIDTH}:{HEIGHT}:force_original_aspect_ratio=decrease,"
+        f"format=yuv420p,pad={WIDTH}:{HEIGHT}:(ow-iw)/2:(oh-ih)/2:color=black,"
+        f"setsar=1,fps={FPS}[v{k}]",
     ]
-    subprocess.run(cmd, capture_output=True, timeout=300, check=True)
+    if has_audio_stream(clip_path):
+        filters.append(f"[{k}:a]{AUDIO_NORMALIZE}[a{k}]")
+    else:
+        filters.append(
+            f"anullsrc=r=44100:cl=stereo,atrim=duration={get_duration(clip_path):.3f},"
+            f"{AUDIO_NORMALIZE}[a{k}]"
+        )
+    return filters
 
 
 def add_watermark(video_path: str, output_path: str, text: str = "Subscribe!"):
     """Add a subtle text watermark to the video."""
     safe_text = text.replace("'", "\\'").replace(":", "\\:")
     cmd = [
-        "ffmpeg", "-y", "-i", video_path,
+        FFMPEG, "-y", "-i", video_path,
         "-vf", (
             f"drawtext=text='{safe_text}'"
             f":fontsize=24:fontcolor=white@0.5"
             f":x=w-tw-20:y=h-th-20"
             f":font=Sans"
         ),
-        "-c:v", "libx264", "-preset", PRESET, "-crf", str(CRF),
+        *h264_args(PRESET, CRF),
         "-c:a", "copy",
-        "-threads", "1",
+        "-threads", ENCODE_THREADS,
         output_path,
     ]
     subprocess.run(cmd, capture_output=True, timeout=600, check=True)
 
 
 def compile_long_video(clips: list, script: dict, audio_manifest: dict) -> str:
-    """Compile the full-length compilation video."""
+    """Compile the full-length compilation video.
+
+    Every narration screen and clip is a branch of one filter graph feeding a
+    single concat filter, so the whole compilation is encoded exactly once.
+    """
     print("  Compiling long-form video...", file=sys.stderr)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+    # One ffmpeg input per segment: (path, is_clip, overlay_text, fontsize)
     segments = []
-    tmp_dir = os.path.join(OUTPUT_DIR, "tmp")
-    os.makedirs(tmp_dir, exist_ok=True)
 
     # Intro narration over black screen
     intro_audio = audio_manifest.get("intro")
     if intro_audio and os.path.exists(intro_audio):
-        intro_dur = get_duration(intro_audio)
-        intro_video = os.path.join(tmp_dir, "intro.mp4")
-        create_text_video("", intro_dur, intro_video)
-        # Merge intro audio
-        intro_merged = os.path.join(tmp_dir, "intro_merged.mp4")
-        cmd = [
-            "ffmpeg", "-y", "-i", intro_video, "-i", intro_audio,
-            "-map", "0:v", "-map", "1:a",
-            "-c:v", "copy", "-c:a", "aac", "-shortest",
-            intro_merged,
-        ]
-        subprocess.run(cmd, capture_output=True, timeout=60, check=True)
-        segments.append(intro_merged)
+        segments.append((intro_audio, False, "", 48))
 
     # Each clip with its narration
     clip_audios = audio_manifest.get("clips", [])
@@ -193,72 +201,75 @@ def compile_long_video(clips: list, script: dict, audio_manifest: dict) -> str:
         # Before narration
         before_audio = clip_audio.get("before")
         if before_audio and os.path.exists(before_audio):
-            before_dur = get_duration(before_audio)
-            before_video = os.path.join(tmp_dir, f"before_{i}.mp4")
-            create_text_video("", before_dur, before_video)
-            before_merged = os.path.join(tmp_dir, f"before_{i}_merged.mp4")
-            cmd = [
-                "ffmpeg", "-y", "-i", before_video, "-i", before_audio,
-                "-map", "0:v", "-map", "1:a",
-                "-c:v", "copy", "-c:a", "aac", "-shortest",
-                before_merged,
-            ]
-            subprocess.run(cmd, capture_output=True, timeout=60, check=True)
-            segments.append(before_merged)
+            segments.append((before_audio, False, "", 48))
 
         # The clip itself (normalized to target dimensions)
-        normalized = os.path.join(tmp_dir, f"clip_{i}_norm.mp4")
-        scale_and_pad(clip_path, normalized, WIDTH, HEIGHT)
-        segments.append(normalized)
+        segments.append((clip_path, True, "", 0))
 
         # After narration
         after_audio = clip_audio.get("after")
         if after_audio and os.path.exists(after_audio):
-            after_dur = get_duration(after_audio)
-            after_video = os.path.join(tmp_dir, f"after_{i}.mp4")
-            create_text_video("", after_dur, after_video)
-            after_merged = os.path.join(tmp_dir, f"after_{i}_merged.mp4")
-            cmd = [
-                "ffmpeg", "-y", "-i", after_video, "-i", after_audio,
-                "-map", "0:v", "-map", "1:a",
-                "-c:v", "copy", "-c:a", "aac", "-shortest",
-                after_merged,
-            ]
-            subprocess.run(cmd, capture_output=True, timeout=60, check=True)
-            segments.append(after_merged)
+            segments.append((after_audio, False, "", 48))
 
     # Outro
     outro_audio = audio_manifest.get("outro")
     if outro_audio and os.path.exists(outro_audio):
-        outro_dur = get_duration(outro_audio)
-        outro_video = os.path.join(tmp_dir, "outro.mp4")
-        create_text_video("SUBSCRIBE FOR MORE!", outro_dur, outro_video, fontsize=64)
-        outro_merged = os.path.join(tmp_dir, "outro_merged.mp4")
-        cmd = [
-            "ffmpeg", "-y", "-i", outro_video, "-i", outro_audio,
-            "-map", "0:v", "-map", "1:a",
-            "-c:v", "copy", "-c:a", "aac", "-shortest",
-            outro_merged,
-        ]
-        subprocess.run(cmd, capture_output=True, timeout=60, check=True)
-        segments.append(outro_merged)
+        segments.append((outro_audio, False, "SUBSCRIBE FOR MORE!", 64))
 
     if not segments:
         print("  [ERR] No segments to compile!", file=sys.stderr)
         return ""
 
-    # Concatenate all segments
-    raw_compilation = os.path.join(OUTPUT_DIR, "compilation_raw.mp4")
-    concat_videos(segments, raw_compilation)
-
-    # Add background music if available
-    final_path = os.path.join(OUTPUT_DIR, "compilation.mp4")
+    # Probe every segment up front in parallel instead of one ffprobe at a time
+    probe_many([seg[0] for seg in segments])
+
+    cmd = [FFMPEG, "-y"]
+    filter_parts = []
+    for k, (path, is_clip, text, fontsize) in enumerate(segments):
+        # Source clips are H.264 video worth decoding on the hardware, if any
+        if is_clip:
+            cmd.extend(hwaccel_args())
+        cmd.extend(["-i", path])
+        if is_clip:
+            filter_parts.extend(_clip_segment(k, path))
+        else:
+            filter_parts.extend(_narration_segment(k, get_duration(path), text, fontsize))
+
+    concat_inputs = "".join(f"[v{k}][a{k}]" for k in range(len(segments)))
+
+    # Background music (if available) is mixed into the concat output in the
+    # same graph, instead of remuxing the finished compilation a second time
     music_files = list(Path(MUSIC_DIR).glob("*.mp3")) if os.path.isdir(MUSIC_DIR) else []
     if music_files:
-        add_background_music(raw_compilation, str(music_files[0]), final_path)
-        os.remove(raw_compilation)
+        music_idx = len(segments)
+        # Loop at the demuxer; aloop would buffer the whole track in the graph
+        cmd.extend(["-stream_loop", "-1", "-i", str(music_files[0])])
+        filter_parts.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=1[vout][acat]")
+        filter_parts.append(
+            f"[{music_idx}:a]volume={MUSIC_VOLUME}[music];"
+            f"[acat][music]amix=inputs=2:duration=first:dropout_transition=3[aout]"
+        )
     else:
-        os.rename(raw_compilation, final_path)
+        filter_parts.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=1[vout][aout]")
+
+    # Concatenate all segments in a single encode
+    final_path = os.path.join(OUTPUT_DIR, "compilation.mp4")
+    graph_args, graph_file = filter_complex_args(";".join(filter_parts))
+    cmd.extend(graph_args)
+    cmd.extend([
+        "-map", "[vout]", "-map", "[aout]",
+        *h264_args(PRESET, CRF),
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "192k" if music_files else "128k",
+        "-movflags", "+faststart",
+        "-threads", ENCODE_THREADS,
+        final_path,
+    ])
+    try:
+        subprocess.run(cmd, capture_output=True, timeout=1800, check=True)
+    finally:
+        if graph_file:
+            os.remove(graph_file)
 
     duration = get_duration(final_path)
     size_mb = os.path.getsize(final_path) / (1024 * 1024)
@@ -267,15 +278,58 @@ def compile_long_video(clips: list, script: dict, audio_manifest: dict) -> str:
     return final_path
 
 
+def _render_one_short(clip_path: str, clip_num: int, short_info: dict,
+                      threads: str = "1") -> dict | None:
+    """Render one vertical short from a clip. Returns its manifest entry or None."""
+    hook_text = short_info.get("hook_text", "WAIT FOR IT")
+    safe_hook = hook_text.replace("'", "\\'").replace(":", "\\:")
+    output_path = os.path.join(SHORTS_DIR, f"short_{clip_num}.mp4")
+
+    # Convert to vertical (crop center) + add hook text overlay. -t on the
+    # input stops demuxing/decoding at SHORTS_MAX_SECONDS instead of reading
+    # the whole clip, which also caps the short's length.
+    cmd = [
+        FFMPEG, "-y", *hwaccel_args(), "-t", str(SHORTS_MAX_SECONDS), "-i", clip_path,
+        "-vf", (
+            f"scale=-2:{SHORTS_HEIGHT},"
+            f"crop={SHORTS_WIDTH}:{SHORTS_HEIGHT},"
+            f"drawtext=text='{safe_hook}'"
+            f":fontsize=56:fontcolor=white:borderw=3:bordercolor=black"
+            f":x=(w-text_w)/2:y=100"
+            f":font=Sans"
+            f":enable='lt(t,3)'"  # Show for first 3 seconds
+        ),
+        *h264_args(PRESET, CRF),
+        "-c:a", "aac", "-b:a", "128k",
+        "-threads", threads,
+        output_path,
+    ]
+
+    try:
+        subprocess.run(cmd, capture_output=True, timeout=180, check=True)
+        print(f"  [OK] Short {clip_num}", file=sys.stderr)
+        return {
+            "path": output_path,
+            "clip_number": clip_num,
+            "hook_text": hook_text,
+            "caption": short_info.get("caption", ""),
+        }
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        print(f"  [ERR] Short {clip_num} failed: {e}", file=sys.stderr)
+        return None
+
+
 def generate_shorts(clips: list, script: dict) -> list:
-    """Generate individual vertical shorts from the best clips."""
+    """Generate individual vertical shorts from the best clips.
+
+    Each short is a single-threaded encode, so they run side by side on a
+    thread pool (one ffmpeg per core) instead of one after another.
+    """
     print("  Generating shorts...", file=sys.stderr)
     os.makedirs(SHORTS_DIR, exist_ok=True)
 
-    shorts_data = script.get("shorts_hooks", [])
-    generated = []
-
-    for short_info in shorts_data:
+    jobs = []
+    for short_info in script.get("shorts_hooks", []):
         clip_num = short_info["clip_number"]
         if clip_num > len(clips):
             continue
@@ -285,42 +339,17 @@ def generate_shorts(clips: list, script: dict) -> list:
         if not clip_path or not os.path.exists(clip_path):
             continue
 
-        hook_text = short_info.get("hook_text", "WAIT FOR IT")
-        safe_hook = hook_text.replace("'", "\\'").replace(":", "\\:")
-        output_path = os.path.join(SHORTS_DIR, f"short_{clip_num}.mp4")
-
-        # Convert to vertical (crop center) + add hook text overlay
-        cmd = [
-            "ffmpeg", "-y", "-i", clip_path,
-            "-vf", (
-                f"scale=-2:{SHORTS_HEIGHT},"
-                f"crop={SHORTS_WIDTH}:{SHORTS_HEIGHT},"
-                f"drawtext=text='{safe_hook}'"
-                f":fontsize=56:fontcolor=white:borderw=3:bordercolor=black"
-                f":x=(w-text_w)/2:y=100"
-                f":font=Sans"
-                f":enable='lt(t,3)'"  # Show for first 3 seconds
-            ),
-            "-c:v", "libx264", "-preset", PRESET, "-crf", str(CRF),
-            "-c:a", "aac", "-b:a", "128k",
-            "-t", "60",  # Max 60s for shorts
-            "-threads", "1",
-            output_path,
-        ]
-
-        try:
-            subprocess.run(cmd, capture_output=True, timeout=180, check=True)
-            generated.append({
-                "path": output_path,
-                "clip_number": clip_num,
-                "hook_text": hook_text,
-                "caption": short_info.get("caption", ""),
-            })
-            print(f"  [OK] Short {clip_num}", file=sys.stderr)
-        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
-            print(f"  [ERR] Short {clip_num} failed: {e}", file=sys.stderr)
-
-    return generated
+        jobs.append((clip_path, clip_num, short_info))
+
+    if not jobs:
+        return []
+
+    workers = min(os.cpu_count() or 1, len(jobs))
+    threads = "1" if workers > 1 else ENCODE_THREADS
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rendered = list(pool.map(lambda job: _render_one_short(*job, threads), jobs))
+
+    return [r for r in rendered if r]
 
 
 def cleanup_temp():
@@ -366,7 +395,7 @@ if __name__ == "__main__":
     }
     manifest_path = os.path.join(OUTPUT_DIR, "manifest.json")
     with open(manifest_path, "w") as f:
-        json.dump(manifest, f, indent=2)
+        f.write(json.dumps(manifest, indent=2))
     print(f"\n  Output manifest: {manifest_path}", file=sys.stderr)
 
     # Cleanup temp files (keep final outputs)
@@ -8,34 +8,52 @@ import json
 import subprocess
 import sys
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from ffmpeg_utils import FFMPEG, FFPROBE, h264_args
+
 MAX_DURATION = 45  # seconds - max clip length
 OUTPUT_DIR = "/pipeline/clips"
 MAX_HEIGHT = 1080
 COOKIES_FILE = "/pipeline/config/cookies.txt"
+YT_DLP = shutil.which("yt-dlp") or "yt-dlp"
+YTDLP_JOBS = int(os.environ.get("YTDLP_JOBS", "2"))  # concurrent yt-dlp fetches (rate limits)
+TRANSCODE_JOBS = int(os.environ.get("TRANSCODE_JOBS", str(os.cpu_count() or 1)))  # ffmpeg -threads 1 each
 
 
 def download_clip(post: dict, output_dir: str) -> dict | None:
     """Download a single clip with yt-dlp and trim it."""
+    final_path = os.path.join(output_dir, f"{post['id']}.mp4")
+    if os.path.exists(final_path):
+        print(f"  [SKIP] {post['id']} already exists", file=sys.stderr)
+        return {**post, "local_path": final_path}
+
+    fetched = _fetch_clip(post, output_dir)
+    if fetched is None:
+        return None
+    return _normalize_clip(post, *fetched, final_path)
+
+
+def _fetch_clip(post: dict, output_dir: str) -> tuple | None:
+    """Download stage: fetch the raw clip with yt-dlp. Returns (raw_path, duration) or None."""
     clip_id = post["id"]
     url = post["url"]
     raw_path = os.path.join(output_dir, f"{clip_id}_raw.mp4")
-    final_path = os.path.join(output_dir, f"{clip_id}.mp4")
-
-    if os.path.exists(final_path):
-        print(f"  [SKIP] {clip_id} already exists", file=sys.stderr)
-        return {**post, "local_path": final_path}
 
     # Download with yt-dlp
     print(f"  [DL] {clip_id}: {post['title'][:60]}...", file=sys.stderr)
     dl_cmd = [
-        "yt-dlp",
+        YT_DLP,
         "--no-warnings",
         "--no-playlist",
         "-f", f"best[height<={MAX_HEIGHT}]/best",
         "--merge-output-format", "mp4",
         "-o", raw_path,
+        # Report the extractor's duration once the file is written, so the
+        # raw clip doesn't need an ffprobe (implies --quiet, not --simulate)
+        "--print", "after_move:%(duration)s",
         "--socket-timeout", "30",
         "--retries", "3",
         "--js-runtimes", "node",
@@ -46,7 +64,7 @@ def download_clip(post: dict, output_dir: str) -> dict | None:
     dl_cmd.append(url)
 
     try:
-        subprocess.run(dl_cmd, capture_output=True, timeout=120, check=True)
+        result = subprocess.run(dl_cmd, capture_output=True, text=True, timeout=120, check=True)
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         print(f"  [ERR] Failed to download {clip_id}: {e}", file=sys.stderr)
         _cleanup(raw_path)
@@ -56,31 +74,58 @@ def download_clip(post: dict, output_dir: str) -> dict | None:
         print(f"  [ERR] No file downloaded for {clip_id}", file=sys.stderr)
         return None
 
-    # Get duration
-    duration = _get_duration(raw_path)
+    # Duration from yt-dlp's metadata; probe only if the extractor had none ("NA")
+    try:
+        duration = float(result.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        duration = _get_duration(raw_path)
     if duration is None or duration < 3:
         print(f"  [SKIP] {clip_id}: too short ({duration}s)", file=sys.stderr)
         _cleanup(raw_path)
         return None
 
-    # Trim if needed + normalize format
+    return raw_path, duration
+
+
+def _normalize_clip(post: dict, raw_path: str, duration: float, final_path: str) -> dict | None:
+    """Transcode stage: trim if needed + normalize format, then drop the raw file.
+
+    Sources that are already H.264/AAC (most YouTube/Reddit downloads) are
+    kept as-is or trimmed with a stream copy instead of being re-encoded.
+    """
+    clip_id = post["id"]
     trim_args = []
     if duration > MAX_DURATION:
         trim_args = ["-t", str(MAX_DURATION)]
         print(f"  [TRIM] {clip_id}: {duration:.0f}s -> {MAX_DURATION}s", file=sys.stderr)
 
+    video_codec, audio_codec = _get_codecs(raw_path)
+    copyable = video_codec == "h264" and audio_codec in ("aac", None)
+
+    if copyable and not trim_args:
+        os.replace(raw_path, final_path)
+        print(f"  [OK] {clip_id}: {duration:.0f}s (kept source)", file=sys.stderr)
+        return {**post, "local_path": final_path, "duration": duration}
+
+    if copyable:
+        codec_args = ["-c", "copy"]
+    else:
+        codec_args = [
+            *h264_args("fast", 23),
+            "-c:a", "aac", "-b:a", "128k",
+            "-threads", "1",
+        ]
+
     ffmpeg_cmd = [
-        "ffmpeg", "-y", "-i", raw_path,
+        FFMPEG, "-y", "-i", raw_path,
         *trim_args,
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-        "-c:a", "aac", "-b:a", "128k",
+        *codec_args,
         "-movflags", "+faststart",
-        "-threads", "1",
         final_path,
     ]
 
     try:
-        subprocess.run(ffmpeg_cmd, capture_output=True, timeout=300, check=True)
+        subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300, check=True)
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         print(f"  [ERR] FFmpeg failed for {clip_id}: {e}", file=sys.stderr)
         _cleanup(raw_path, final_path)
@@ -89,7 +134,7 @@ def download_clip(post: dict, output_dir: str) -> dict | None:
     # Cleanup raw file
     _cleanup(raw_path)
 
-    actual_duration = _get_duration(final_path) or MAX_DURATION
+    actual_duration = min(duration, MAX_DURATION)
     print(f"  [OK] {clip_id}: {actual_duration:.0f}s", file=sys.stderr)
 
     return {**post, "local_path": final_path, "duration": actual_duration}
@@ -99,15 +144,32 @@ def _get_duration(filepath: str) -> float | None:
     """Get video duration using ffprobe."""
     try:
         result = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
+            [FFPROBE, "-v", "quiet", "-show_entries", "format=duration",
              "-of", "csv=p=0", filepath],
-            capture_output=True, text=True, timeout=30
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30
         )
         return float(result.stdout.strip())
     except (ValueError, subprocess.TimeoutExpired):
         return None
 
 
+def _get_codecs(filepath: str) -> tuple:
+    """(video_codec, audio_codec) of a file via one ffprobe; None for a missing stream."""
+    try:
+        result = subprocess.run(
+            [FFPROBE, "-v", "quiet", "-show_entries", "stream=codec_type,codec_name",
+             "-of", "json", filepath],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30
+        )
+        streams = json.loads(result.stdout).get("streams", [])
+    except (ValueError, subprocess.TimeoutExpired):
+        return None, None
+    codecs = {}
+    for stream in streams:
+        codecs.setdefault(stream.get("codec_type"), stream.get("codec_name"))
+    return codecs.get("video"), codecs.get("audio")
+
+
 def _cleanup(*paths):
     """Remove files if they exist."""
     for p in paths:
@@ -124,18 +186,42 @@ def download_all(posts_file: str, output_dir: str = OUTPUT_DIR) -> list:
     with open(posts_file) as f:
         posts = json.load(f)
 
-    results = []
-    for post in posts:
-        result = download_clip(post, output_dir)
-        if result:
-            results.append(result)
+    # Two-stage pipeline: network-bound yt-dlp fetches feed CPU-bound ffmpeg
+    # transcodes as soon as each one lands, so clip B downloads while clip A
+    # encodes. Both stages are subprocesses, so plain threads overlap fine.
+    slots = [None] * len(posts)
+    # One directory listing instead of a stat per post for the skip check
+    existing = {entry.name for entry in os.scandir(output_dir)}
+    with ThreadPoolExecutor(max_workers=max(1, YTDLP_JOBS)) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=max(1, TRANSCODE_JOBS)) as transcode_pool:
+        fetches = {}
+        for i, post in enumerate(posts):
+            final_path = os.path.join(output_dir, f"{post['id']}.mp4")
+            if f"{post['id']}.mp4" in existing:
+                print(f"  [SKIP] {post['id']} already exists", file=sys.stderr)
+                slots[i] = {**post, "local_path": final_path}
+            else:
+                fetches[fetch_pool.submit(_fetch_clip, post, output_dir)] = (i, final_path)
+
+        transcodes = {}
+        for future in as_completed(fetches):
+            fetched = future.result()
+            if fetched is None:
+                continue
+            i, final_path = fetches[future]
+            transcodes[i] = transcode_pool.submit(_normalize_clip, posts[i], *fetched, final_path)
+
+        for i, future in transcodes.items():
+            slots[i] = future.result()
+
+    results = [r for r in slots if r]
 
     print(f"\n  Downloaded {len(results)}/{len(posts)} clips", file=sys.stderr)
 
     # Save results
     results_path = os.path.join(output_dir, "downloaded.json")
     with open(results_path, "w") as f:
-        json.dump(results, f, indent=2)
+        f.write(json.dumps(results, indent=2))
 
     return results
 
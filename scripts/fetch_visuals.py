@@ -5,16 +5,30 @@ Creates Ken Burns effect (slow zoom/pan) on each image for engaging visuals.
 Falls back to Pexels stock footage if image generation fails.
 """
 
+import hashlib
 import json
 import os
 import subprocess
 import sys
+import urllib.error
 import urllib.request
 import urllib.parse
-import time
 import random
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ffmpeg_utils import FFMPEG, filter_complex_args, h264_args
+from http_utils import TokenBucket, open_url, retry_after
 
 VISUALS_DIR = "/pipeline/visuals"
+# Segment visuals are intermediates: the final cut re-encodes them to H.264
+# anyway, so Ken Burns renders use cheap intra-only MJPEG instead of a second
+# full x264 pass. MKV holds that as well as the H.264 fallback clips.
+VISUAL_EXT = "mkv"
+INTERMEDIATE_ARGS = ["-c:v", "mjpeg", "-q:v", "3", "-pix_fmt", "yuvj420p"]
 TARGET_WIDTH = 1080
 TARGET_HEIGHT = 1920
 FPS = 30
@@ -27,14 +41,44 @@ HF_API_URL = "https://router.huggingface.co/hf-inference/models/black-forest-lab
 # Pexels as fallback
 PEXELS_API_URL = "https://api.pexels.com/videos/search"
 
+VISUAL_JOBS = int(os.environ.get("VISUAL_JOBS", "4"))  # segments processed at once
+HF_CONCURRENCY = int(os.environ.get("HF_CONCURRENCY", "2"))  # image requests in flight
+
+HF_MAX_WAIT = 60  # seconds; a longer Retry-After goes straight to the fallback
+
+_hf_slots = threading.Semaphore(max(1, HF_CONCURRENCY))
+
+# Request pacing per upstream API; only blocks once the burst is used up
+_hf_bucket = TokenBucket(rate=1.0, capacity=2)
+_pexels_bucket = TokenBucket(rate=5.0, capacity=10)
+
+COPY_BUFFER = 1 << 20  # 1MB reads when streaming downloads to disk
+
+# FLUX results by prompt, so a prompt seen before (the narration fallback
+# template especially) costs no HF call. Pruned oldest-first past the age/size caps.
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", f"{VISUALS_DIR}/_cache")
+IMAGE_CACHE_DAYS = int(os.environ.get("IMAGE_CACHE_DAYS", "14"))
+IMAGE_CACHE_MB = int(os.environ.get("IMAGE_CACHE_MB", "500"))
+
+_cache_lock = threading.Lock()
+_cache_pruned = False
+
 
 def generate_ai_image(prompt: str, output_path: str, hf_token: str = "") -> bool:
     """Generate an AI image. HuggingFace FLUX first (best quality), Pollinations fallback."""
 
+    # A leftover output may be a hard link into the cache; never write through it
+    _remove_quietly(output_path)
+
     # Method 1: HuggingFace FLUX (best quality, handles faces well)
     if hf_token:
         hf_prompt = f"{prompt}, photorealistic, 8K, cinematic photography, shallow depth of field"
+        cache_path = _image_cache_path(hf_prompt)
+        if _cache_fetch(cache_path, output_path):
+            print("    [CACHE] Reusing FLUX image for this prompt", file=sys.stderr)
+            return True
         if _generate_flux(hf_prompt, output_path, hf_token):
+            _cache_store(output_path, cache_path)
             return True
         print("    [INFO] HF failed, falling back to Pollinations", file=sys.stderr)
 
@@ -44,21 +88,106 @@ def generate_ai_image(prompt: str, output_path: str, hf_token: str = "") -> bool
     return _generate_pollinations(enhanced, output_path)
 
 
-def _to_environmental(prompt: str) -> str:
-    """Convert a face/portrait prompt to an environmental/atmospheric one for Pollinations."""
-    import re
-    # Remove face-related terms
-    removals = [
+def _image_cache_path(prompt: str) -> str:
+    key = hashlib.sha256(f"{HF_API_URL}|{prompt}".encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, f"{key}.jpg")
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _file_size(path: str) -> int:
+    """Size in bytes with a single stat, or 0 if the file is missing."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _link_or_copy(src: str, dst: str):
+    """Hard-link src to dst (copying across filesystems), replacing dst."""
+    _remove_quietly(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _cache_fetch(cache_path: str, output_path: str) -> bool:
+    """Place a cached image at output_path. False on a miss."""
+    try:
+        if os.path.getsize(cache_path) <= 5000:
+            return False
+        _link_or_copy(cache_path, output_path)
+        os.utime(cache_path)  # recently used: pruned last
+        return True
+    except OSError:
+        return False
+
+
+def _cache_store(output_path: str, cache_path: str):
+    """Add a fresh image to the cache (best effort), pruning once per process."""
+    global _cache_pruned
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        tmp = f"{cache_path}.{threading.get_ident()}.tmp"
+        _link_or_copy(output_path, tmp)
+        os.replace(tmp, cache_path)
+    except OSError:
+        return
+    with _cache_lock:
+        if _cache_pruned:
+            return
+        _cache_pruned = True
+    _prune_image_cache()
+
+
+def _prune_image_cache():
+    """Drop cache entries older than IMAGE_CACHE_DAYS, then oldest first down to IMAGE_CACHE_MB."""
+    try:
+        entries = sorted(
+            (st.st_mtime, st.st_size, entry.path)
+            for entry in os.scandir(IMAGE_CACHE_DIR)
+            if entry.name.endswith(".jpg") and (st := entry.stat())
+        )
+    except OSError:
+        return
+    cutoff = time.time() - IMAGE_CACHE_DAYS * 86400
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= IMAGE_CACHE_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+# Face-related terms stripped from prompts before they go to Pollinations
+_FACE_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
         r"close up portrait of [^,]+,",
         r"portrait of [^,]+,",
         r"[^,]*facial expression[^,]*,",
         r"[^,]*expression[^,]*with [^,]*eyes[^,]*,",
         r"both faces visible,",
         r"natural skin texture[^,]*,",
-    ]
+    )
+]
+
+
+def _to_environmental(prompt: str) -> str:
+    """Convert a face/portrait prompt to an environmental/atmospheric one for Pollinations."""
+    # Remove face-related terms
     result = prompt
-    for pattern in removals:
-        result = re.sub(pattern, "", result, flags=re.IGNORECASE)
+    for pattern in _FACE_PATTERNS:
+        result = pattern.sub("", result)
     # Add environmental direction
     result = f"cinematic scene, no people, no faces, {result.strip().strip(',').strip()}, dark moody atmosphere, dramatic lighting"
     return result
@@ -67,6 +196,14 @@ def _to_environmental(prompt: str) -> str:
 NEGATIVE_PROMPT = "face,portrait,person close up,cartoon,anime,painting,illustration,drawing,sketch,blurry,deformed,ugly,bad anatomy,extra fingers,mutated hands,disfigured,bad proportions,watermark,text,logo"
 
 
+# Pollinations error images are PNGs containing telltale text (rate limit,
+# moved, sign up, etc.) in their metadata chunks, which sit before the image
+# data or just before IEND - so only both ends of the file need scanning
+SPAM_MARKERS = (b"pollinations.ai", b"rate limit", b"we have moved",
+                b"sign up here", b"enter.pollinations", b"anonymous tier")
+SPAM_SCAN_BYTES = 8192
+
+
 def _generate_pollinations(prompt: str, output_path: str) -> bool:
     """Generate image via Pollinations.ai new API (gen.pollinations.ai)."""
     encoded = urllib.parse.quote(prompt)
@@ -79,38 +216,27 @@ def _generate_pollinations(prompt: str, output_path: str) -> bool:
         if POLLINATIONS_API_KEY:
             headers["Authorization"] = f"Bearer {POLLINATIONS_API_KEY}"
         req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req, timeout=90) as resp:
-            with open(output_path, "wb") as f:
-                while True:
-                    chunk = resp.read(65536)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-        if not (os.path.exists(output_path) and os.path.getsize(output_path) > 5000):
+        # The body is checked for placeholders below, so keep it in memory
+        # and only write it out once it passes
+        with open_url(req, timeout=90) as resp:
+            raw = resp.read()
+        if len(raw) <= 5000:
             return False
         # Check if Pollinations returned a placeholder/error image instead of real content
-        try:
-            with open(output_path, "rb") as check_f:
-                raw = check_f.read()
-            # Pollinations error images are PNGs containing telltale text
-            # (rate limit, moved, sign up, etc.) - check raw bytes for these strings
-            raw_lower = raw.lower()
-            spam_markers = [b"pollinations.ai", b"rate limit", b"we have moved",
-                            b"sign up here", b"enter.pollinations", b"anonymous tier"]
-            for marker in spam_markers:
-                if marker in raw_lower:
-                    print(f"    [WARN] Pollinations placeholder image detected ({marker.decode()}), discarding",
-                          file=sys.stderr)
-                    os.remove(output_path)
-                    return False
-            # Also reject PNGs under 200KB (real 1080x1920 images are larger)
-            if b"PNG" in raw[:16] and len(raw) < 200000:
-                print(f"    [WARN] Pollinations small PNG detected ({len(raw)//1024}KB), discarding",
-                      file=sys.stderr)
-                os.remove(output_path)
-                return False
-        except Exception:
-            pass
+        view = memoryview(raw)
+        sample = (bytes(view[:SPAM_SCAN_BYTES]) + b"\n" + bytes(view[-SPAM_SCAN_BYTES:])).lower()
+        marker = next((m for m in SPAM_MARKERS if m in sample), None)
+        if marker:
+            print(f"    [WARN] Pollinations placeholder image detected ({marker.decode()}), discarding",
+                  file=sys.stderr)
+            return False
+        # Also reject PNGs under 200KB (real 1080x1920 images are larger)
+        if b"PNG" in raw[:16] and len(raw) < 200000:
+            print(f"    [WARN] Pollinations small PNG detected ({len(raw)//1024}KB), discarding",
+                  file=sys.stderr)
+            return False
+        with open(output_path, "wb") as f:
+            f.write(raw)
         return True
     except Exception as e:
         print(f"    [WARN] Pollinations failed: {e}", file=sys.stderr)
@@ -118,56 +244,111 @@ def _generate_pollinations(prompt: str, output_path: str) -> bool:
 
 
 def _generate_flux(prompt: str, output_path: str, hf_token: str) -> bool:
-    """Generate image via HuggingFace FLUX (fallback)."""
+    """Generate image via HuggingFace FLUX.
+
+    No fixed delay between calls: the shared bucket paces them, and a 429/503
+    pauses it for as long as HF asks (Retry-After, or the model's loading
+    estimate) before one retry.
+    """
     body = json.dumps({"inputs": prompt}).encode()
+    req = urllib.request.Request(HF_API_URL, data=body, headers={
+        "Authorization": f"Bearer {hf_token}",
+        "Content-Type": "application/json",
+        "User-Agent": "Mozilla/5.0 (X11; Linux aarch64) AppleWebKit/537.36 Chrome/120.0.0.0",
+    })
+    for attempt in range(2):
+        try:
+            with _hf_slots:  # Respect HuggingFace rate limits, whoever the caller
+                _hf_bucket.acquire()
+                with open_url(req, timeout=120) as resp:
+                    with open(output_path, "wb") as f:
+                        shutil.copyfileobj(resp, f, length=COPY_BUFFER)
+            return _file_size(output_path) > 5000
+        except urllib.error.HTTPError as e:
+            delay = _hf_backoff(e) if e.code in (429, 503) else None
+            if attempt or delay is None or delay > HF_MAX_WAIT:
+                print(f"    [WARN] FLUX failed: {e}", file=sys.stderr)
+                return False
+            print(f"    [INFO] FLUX busy ({e.code}), waiting {delay:.0f}s", file=sys.stderr)
+            _hf_bucket.pause(delay)
+        except Exception as e:
+            print(f"    [WARN] FLUX failed: {e}", file=sys.stderr)
+            return False
+    return False
+
+
+def _hf_backoff(err: urllib.error.HTTPError) -> float | None:
+    """How long HF wants us to back off: Retry-After, else a loading model's estimate."""
+    delay = retry_after(err)
+    if delay is not None:
+        return delay
     try:
-        req = urllib.request.Request(HF_API_URL, data=body, headers={
-            "Authorization": f"Bearer {hf_token}",
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 (X11; Linux aarch64) AppleWebKit/537.36 Chrome/120.0.0.0",
-        })
-        with urllib.request.urlopen(req, timeout=120) as resp:
-            with open(output_path, "wb") as f:
-                while True:
-                    chunk = resp.read(65536)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 5000
-    except Exception as e:
-        print(f"    [WARN] FLUX failed: {e}", file=sys.stderr)
-        return False
+        return float(json.loads(err.read()).get("estimated_time"))
+    except (OSError, ValueError, TypeError, AttributeError):
+        return 5.0 if err.code == 429 else None
 
 
-def create_ken_burns(image_path: str, output_path: str, duration: float,
-                     effect: str = "zoom_in"):
-    """Create Ken Burns effect (slow zoom/pan) on a still image."""
+def _ken_burns_filter(duration: float, effect: str = "zoom_in") -> str:
+    """zoompan filter for one Ken Burns effect (slow zoom/pan) over duration seconds."""
     # Different effects for variety
     if effect == "zoom_in":
         # Slow zoom in from 1.0x to 1.15x
-        zoompan = f"zoompan=z='min(zoom+0.0008,1.15)':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
+        return f"zoompan=z='min(zoom+0.0008,1.15)':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
     elif effect == "zoom_out":
         # Slow zoom out from 1.15x to 1.0x
-        zoompan = f"zoompan=z='if(eq(on,1),1.15,max(zoom-0.0008,1.0))':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
+        return f"zoompan=z='if(eq(on,1),1.15,max(zoom-0.0008,1.0))':x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
     elif effect == "pan_right":
         # Slow pan from left to right
-        zoompan = f"zoompan=z='1.15':x='if(eq(on,1),0,min(x+1,iw-iw/zoom))':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
+        return f"zoompan=z='1.15':x='if(eq(on,1),0,min(x+1,iw-iw/zoom))':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
     else:
         # Pan left
-        zoompan = f"zoompan=z='1.15':x='if(eq(on,1),iw-iw/zoom,max(x-1,0))':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
+        return f"zoompan=z='1.15':x='if(eq(on,1),iw-iw/zoom,max(x-1,0))':y='ih/2-(ih/zoom/2)':d={int(duration*FPS)}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:fps={FPS}"
+
 
+def create_ken_burns(image_path: str, output_path: str, duration: float,
+                     effect: str = "zoom_in"):
+    """Create Ken Burns effect (slow zoom/pan) on a still image."""
     cmd = [
-        "ffmpeg", "-y",
+        FFMPEG, "-y",
         "-loop", "1", "-i", image_path,
-        "-vf", zoompan,
+        "-vf", _ken_burns_filter(duration, effect),
         "-t", str(duration),
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-        "-pix_fmt", "yuv420p",
+        *INTERMEDIATE_ARGS,
         "-threads", "1",
         output_path,
     ]
 
-    subprocess.run(cmd, capture_output=True, timeout=180, check=True)
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=180, check=True)
+
+
+def create_ken_burns_many(jobs: list):
+    """Render several Ken Burns clips in one ffmpeg process.
+
+    jobs: (image_path, output_path, duration, effect) tuples. Each image is
+    its own input and filter chain, mapped to its own output file, so ffmpeg
+    starts and initializes once for the whole batch.
+    """
+    cmd = [FFMPEG, "-y"]
+    chains = []
+    for k, (image_path, _, duration, effect) in enumerate(jobs):
+        cmd.extend(["-loop", "1", "-t", str(duration), "-i", image_path])
+        chains.append(f"[{k}:v]{_ken_burns_filter(duration, effect)}[kb{k}]")
+
+    graph_args, graph_file = filter_complex_args(";".join(chains))
+    cmd.extend(graph_args)
+    for k, (_, output_path, duration, _) in enumerate(jobs):
+        cmd.extend([
+            "-map", f"[kb{k}]",
+            "-t", str(duration),
+            *INTERMEDIATE_ARGS,
+            output_path,
+        ])
+
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=180 * len(jobs), check=True)
+    finally:
+        if graph_file:
+            os.remove(graph_file)
 
 
 def search_pexels(query: str, api_key: str, per_page: int = 3) -> list:
@@ -178,8 +359,9 @@ def search_pexels(query: str, api_key: str, per_page: int = 3) -> list:
         "User-Agent": "viral-pipeline/1.0",
     })
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            data = json.loads(resp.read().decode())
+        _pexels_bucket.acquire()
+        with open_url(req, timeout=15) as resp:
+            data = json.loads(resp.read())
             results = []
             for video in data.get("videos", []):
                 for vf in video.get("video_files", []):
@@ -195,14 +377,10 @@ def download_file(url: str, output_path: str) -> bool:
     """Download a file from URL."""
     try:
         req = urllib.request.Request(url, headers={"User-Agent": "viral-pipeline/1.0"})
-        with urllib.request.urlopen(req, timeout=60) as resp:
+        with open_url(req, timeout=60) as resp:
             with open(output_path, "wb") as f:
-                while True:
-                    chunk = resp.read(65536)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-        return os.path.exists(output_path) and os.path.getsize(output_path) > 1000
+                shutil.copyfileobj(resp, f, length=COPY_BUFFER)
+        return _file_size(output_path) > 1000
     except Exception:
         return False
 
@@ -210,19 +388,19 @@ def download_file(url: str, output_path: str) -> bool:
 def normalize_video(input_path: str, output_path: str, target_duration: float):
     """Scale and loop a video clip to target duration."""
     cmd = [
-        "ffmpeg", "-y", "-stream_loop", "-1", "-i", input_path,
+        FFMPEG, "-y", "-stream_loop", "-1", "-i", input_path,
         "-t", str(target_duration),
         "-vf", (
             f"scale={TARGET_WIDTH}:{TARGET_HEIGHT}:force_original_aspect_ratio=decrease,"
             f"pad={TARGET_WIDTH}:{TARGET_HEIGHT}:(ow-iw)/2:(oh-ih)/2:color=black,"
             f"setsar=1"
         ),
-        "-c:v", "libx264", "-preset", "fast", "-crf", "26",
+        *h264_args("fast", 26),
         "-an", "-r", str(FPS),
         "-threads", "1",
         output_path,
     ]
-    subprocess.run(cmd, capture_output=True, timeout=120, check=True)
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=120, check=True)
 
 
 # Ken Burns effects to alternate between
@@ -232,81 +410,128 @@ EFFECTS = ["zoom_in", "zoom_out", "pan_right", "pan_left"]
 def fetch_visuals_for_segments(segments: list, output_dir: str,
                                 hf_token: str = None,
                                 pexels_key: str = None) -> list:
-    """Generate AI visuals for each story segment."""
+    """Generate AI visuals for each story segment.
+
+    AI images for all segments are requested on a thread pool (VISUAL_JOBS at
+    a time, HF_CONCURRENCY in flight), then rendered to Ken Burns clips in a
+    single ffmpeg run. Segments without an image fall back to Pexels, then to
+    a gradient background.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    results = []
 
+    visual_paths = []
+    pending = []  # (index, segment, visual_path) still to produce
+    existing = {entry.name for entry in os.scandir(output_dir)}
     for i, seg in enumerate(segments):
         seg_num = seg.get("segment_number", i + 1)
-        keywords = seg.get("visual_keywords", [])
-        narration = seg.get("narration", "")
-        duration = seg.get("audio_duration", 15)
-        visual_path = os.path.join(output_dir, f"visual_{seg_num}.mp4")
-
-        if os.path.exists(visual_path):
-            results.append(visual_path)
-            continue
-
-        got_visual = False
+        visual_path = os.path.join(output_dir, f"visual_{seg_num}.{VISUAL_EXT}")
+        visual_paths.append(visual_path)
+        if f"visual_{seg_num}.{VISUAL_EXT}" not in existing:
+            pending.append((i, seg, visual_path))
 
+    with ThreadPoolExecutor(max_workers=max(1, VISUAL_JOBS)) as pool:
         # Method 1: AI-generated image with Ken Burns effect (HuggingFace FLUX)
-        if keywords and hf_token:
-            image_prompt = " ".join(keywords[:3])
-            if narration:
-                # Use first sentence of narration for context
-                first_sentence = narration.split(".")[0][:100]
-                image_prompt = f"{first_sentence}, {image_prompt}"
-
-            image_path = os.path.join(output_dir, f"img_{seg_num}.jpg")
-            print(f"    Generating AI image {seg_num}: '{' '.join(keywords[:2])}'...",
+        images = []
+        if hf_token:
+            images = list(pool.map(lambda job: _segment_image(*job[:2], output_dir, hf_token),
+                                   pending))
+        kb_jobs = [
+            (image_path, visual_path, seg.get("audio_duration", 15), EFFECTS[i % len(EFFECTS)])
+            for (i, seg, visual_path), image_path in zip(pending, images)
+            if image_path
+        ]
+        if kb_jobs:
+            _render_ken_burns(kb_jobs)
+
+        # Method 2/3: Pexels stock video, then gradient, for whatever is left
+        missing = [job for job in pending if not os.path.exists(job[2])]
+        list(pool.map(lambda job: _fallback_visual(*job, output_dir, pexels_key), missing))
+
+    return visual_paths
+
+
+def _segment_image(i: int, seg: dict, output_dir: str, hf_token: str) -> str | None:
+    """Generate the AI image for one segment. Returns its path or None."""
+    seg_num = seg.get("segment_number", i + 1)
+    keywords = seg.get("visual_keywords", [])
+    narration = seg.get("narration", "")
+    if not keywords:
+        return None
+
+    image_prompt = " ".join(keywords[:3])
+    if narration:
+        # Use first sentence of narration for context
+        first_sentence = narration.split(".")[0][:100]
+        image_prompt = f"{first_sentence}, {image_prompt}"
+
+    image_path = os.path.join(output_dir, f"img_{seg_num}.jpg")
+    print(f"    Generating AI image {seg_num}: '{' '.join(keywords[:2])}'...",
+          file=sys.stderr)
+
+    if generate_ai_image(image_prompt, image_path, hf_token):
+        return image_path
+    return None
+
+
+def _render_ken_burns(jobs: list):
+    """Render Ken Burns clips in one batch, falling back to one ffmpeg per image."""
+    try:
+        create_ken_burns_many(jobs)
+    except Exception as e:
+        print(f"    [WARN] Batched Ken Burns failed ({e}), rendering one by one",
+              file=sys.stderr)
+        for image_path, visual_path, duration, effect in jobs:
+            try:
+                create_ken_burns(image_path, visual_path, duration, effect)
+            except Exception as e:
+                print(f"    [WARN] Ken Burns failed: {e}", file=sys.stderr)
+                try:
+                    os.remove(visual_path)
+                except OSError:
+                    pass
+
+    for image_path, visual_path, _, effect in jobs:
+        if os.path.exists(visual_path):
+            print(f"    [OK] {os.path.basename(visual_path)}: FLUX AI image + {effect}",
                   file=sys.stderr)
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+
 
-            if generate_ai_image(image_prompt, image_path, hf_token):
+def _fallback_visual(i: int, seg: dict, visual_path: str, output_dir: str,
+                     pexels_key: str):
+    """Pexels stock clip for a segment, or a gradient background as last resort."""
+    seg_num = seg.get("segment_number", i + 1)
+    keywords = seg.get("visual_keywords", [])
+    duration = seg.get("audio_duration", 15)
+    got_visual = False
+
+    # Method 2: Pexels stock video (fallback)
+    if pexels_key and keywords:
+        query = " ".join(keywords[:2])
+        print(f"    Fallback Pexels: '{query}'...", file=sys.stderr)
+        clips = search_pexels(query, pexels_key)
+        if clips:
+            raw_path = os.path.join(output_dir, f"raw_{seg_num}.mp4")
+            if download_file(clips[0]["url"], raw_path):
                 try:
-                    effect = EFFECTS[i % len(EFFECTS)]
-                    create_ken_burns(image_path, visual_path, duration, effect)
+                    normalize_video(raw_path, visual_path, duration)
                     got_visual = True
-                    print(f"    [OK] Visual {seg_num}: FLUX AI image + {effect}",
-                          file=sys.stderr)
-                except Exception as e:
-                    print(f"    [WARN] Ken Burns failed: {e}", file=sys.stderr)
+                    print(f"    [OK] Visual {seg_num}: Pexels clip", file=sys.stderr)
+                except Exception:
+                    pass
                 finally:
                     try:
-                        os.remove(image_path)
+                        os.remove(raw_path)
                     except OSError:
                         pass
 
-            time.sleep(2)  # Respect HuggingFace rate limits
-
-        # Method 2: Pexels stock video (fallback)
-        if not got_visual and pexels_key and keywords:
-            query = " ".join(keywords[:2])
-            print(f"    Fallback Pexels: '{query}'...", file=sys.stderr)
-            clips = search_pexels(query, pexels_key)
-            if clips:
-                raw_path = os.path.join(output_dir, f"raw_{seg_num}.mp4")
-                if download_file(clips[0]["url"], raw_path):
-                    try:
-                        normalize_video(raw_path, visual_path, duration)
-                        got_visual = True
-                        print(f"    [OK] Visual {seg_num}: Pexels clip", file=sys.stderr)
-                    except Exception:
-                        pass
-                    finally:
-                        try:
-                            os.remove(raw_path)
-                        except OSError:
-                            pass
-            time.sleep(0.5)
-
-        # Method 3: Dark gradient background (last resort)
-        if not got_visual:
-            _create_gradient_bg(duration, visual_path, i)
-            print(f"    [OK] Visual {seg_num}: gradient background", file=sys.stderr)
-
-        results.append(visual_path)
-
-    return results
+    # Method 3: Dark gradient background (last resort)
+    if not got_visual:
+        _create_gradient_bg(duration, visual_path, i)
+        print(f"    [OK] Visual {seg_num}: gradient background", file=sys.stderr)
 
 
 def _create_gradient_bg(duration: float, output_path: str, index: int):
@@ -320,16 +545,16 @@ def _create_gradient_bg(duration: float, output_path: str, index: int):
     ]
     c1, c2 = colors[index % len(colors)]
     cmd = [
-        "ffmpeg", "-y",
+        FFMPEG, "-y",
         "-f", "lavfi", "-i",
         f"color=c={c1}:s={TARGET_WIDTH}x{TARGET_HEIGHT}:d={duration}:r={FPS}",
         "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo",
         "-t", str(duration),
-        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "28",
+        *h264_args("ultrafast", 28),
         "-c:a", "aac", "-shortest",
         output_path,
     ]
-    subprocess.run(cmd, capture_output=True, timeout=60, check=True)
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60, check=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Shared FFmpeg helpers: H.264 encoder and decoder selection, filter graph arguments.
+
+Picks a hardware H.264 encoder when the host has one that actually works,
+otherwise falls back to libx264. The result is detected once per host and
+cached in /tmp (keyed by the ffmpeg binary), so later runs skip the probe.
+Set H264_ENCODER to force a specific encoder (e.g. H264_ENCODER=libx264).
+Hardware decoding of input clips is enabled when ffmpeg lists any hwaccel;
+set HWACCEL to pick one (e.g. HWACCEL=cuda) or HWACCEL=none to disable it.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# Tried in order; the first one that can encode a test frame wins
+HW_ENCODERS = ["h264_v4l2m2m", "h264_rkmpp", "h264_videotoolbox", "h264_nvenc", "h264_qsv"]
+HW_BITRATE = "4M"  # Hardware encoders ignore CRF, so target a bitrate instead
+
+# Graphs longer than this go through a script file to stay well under ARG_MAX
+FILTER_SCRIPT_THRESHOLD = 100_000
+
+# Resolved once so each launch execs an absolute path instead of searching PATH
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+
+CAPS_CACHE = os.environ.get("FFMPEG_CAPS_CACHE", "/tmp/ffmpeg_caps.json")
+
+_h264_encoder = None
+_hwaccel = None
+# Held while detecting, so threads rendering side by side probe ffmpeg once
+# (and don't interleave their read-modify-write of CAPS_CACHE)
+_detect_lock = threading.Lock()
+
+
+def _ffmpeg_key() -> str:
+    """Identify the installed ffmpeg binary so an upgrade invalidates the cache."""
+    try:
+        st = os.stat(FFMPEG)
+    except OSError:
+        return FFMPEG
+    return f"{FFMPEG}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _load_caps() -> dict:
+    try:
+        with open(CAPS_CACHE) as f:
+            caps = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return caps if caps.get("ffmpeg") == _ffmpeg_key() else {}
+
+
+def _save_caps(caps: dict):
+    """Atomically rewrite the caps cache (best effort): readers never see half a file."""
+    caps["ffmpeg"] = _ffmpeg_key()
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CAPS_CACHE) or None, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(caps, f)
+        os.replace(tmp, CAPS_CACHE)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _encoder_works(encoder: str) -> bool:
+    """Encode a few blank frames to check the encoder (and its device) is usable."""
+    cmd = [
+        FFMPEG, "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.2",
+        "-c:v", encoder, "-pix_fmt", "yuv420p",
+        "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=20).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def detect_h264_encoder() -> str:
+    """Return the best available H.264 encoder name (cached)."""
+    global _h264_encoder
+    if _h264_encoder:
+        return _h264_encoder
+
+    with _detect_lock:
+        if _h264_encoder:  # another thread finished detecting while we waited
+            return _h264_encoder
+
+        forced = os.environ.get("H264_ENCODER", "")
+        if forced:
+            _h264_encoder = forced
+            return _h264_encoder
+
+        caps = _load_caps()
+        if caps.get("h264_encoder"):
+            _h264_encoder = caps["h264_encoder"]
+            return _h264_encoder
+
+        try:
+            listing = subprocess.run(
+                [FFMPEG, "-hide_banner", "-encoders"],
+                capture_output=True, text=True, timeout=20
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            listing = ""
+
+        _h264_encoder = "libx264"
+        for encoder in HW_ENCODERS:
+            if f" {encoder} " in listing and _encoder_works(encoder):
+                _h264_encoder = encoder
+                break
+
+        caps["h264_encoder"] = _h264_encoder
+        _save_caps(caps)
+        return _h264_encoder
+
+
+def h264_args(preset: str, crf: int) -> list:
+    """FFmpeg video codec arguments for the detected H.264 encoder.
+
+    libx264 keeps the caller's preset/CRF; hardware encoders get a bitrate.
+    """
+    encoder = detect_h264_encoder()
+    if encoder == "libx264":
+        return ["-c:v", "libx264", "-preset", preset, "-crf", str(crf)]
+    return ["-c:v", encoder, "-b:v", HW_BITRATE]
+
+
+def detect_hwaccel() -> str:
+    """Return the -hwaccel value for input decoding, or "" for software (cached)."""
+    global _hwaccel
+    if _hwaccel is not None:
+        return _hwaccel
+
+    with _detect_lock:
+        if _hwaccel is not None:  # another thread finished detecting while we waited
+            return _hwaccel
+
+        forced = os.environ.get("HWACCEL", "")
+        if forced:
+            _hwaccel = "" if forced == "none" else forced
+            return _hwaccel
+
+        caps = _load_caps()
+        if "hwaccel" in caps:
+            _hwaccel = caps["hwaccel"]
+            return _hwaccel
+
+        try:
+            listing = subprocess.run(
+                [FFMPEG, "-hide_banner", "-hwaccels"],
+                capture_output=True, text=True, timeout=20
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            listing = ""
+
+        # First line is the "Hardware acceleration methods:" header. "auto" lets
+        # ffmpeg pick one per input and fall back to software if it can't decode.
+        methods = [line.strip() for line in listing.splitlines()[1:] if line.strip()]
+        _hwaccel = "auto" if methods else ""
+
+        caps["hwaccel"] = _hwaccel
+        _save_caps(caps)
+        return _hwaccel
+
+
+def hwaccel_args() -> list:
+    """Input arguments (placed before -i) enabling hardware decoding, if any.
+
+    Decoded frames are downloaded to system memory so the usual software
+    filters (scale, pad, drawtext...) keep working unchanged.
+    """
+    hwaccel = detect_hwaccel()
+    return ["-hwaccel", hwaccel] if hwaccel else []
+
+
+def filter_complex_args(graph: str) -> tuple:
+    """Arguments passing a filter graph to ffmpeg, plus a temp file to remove (or None).
+
+    Short graphs go inline with -filter_complex; long ones are written to a
+    file and passed with -filter_complex_script.
+    """
+    if len(graph) <= FILTER_SCRIPT_THRESHOLD:
+        return ["-filter_complex", graph], None
+
+    fd, script_path = tempfile.mkstemp(prefix="filter_", suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.write(graph)
+    return ["-filter_complex_script", script_path], script_path
@@ -6,13 +6,19 @@ and convert to audio using edge-tts.
 
 import json
 import os
+import shutil
 import subprocess
 import sys
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from http_utils import open_url
 
 GROQ_MODEL = "llama-3.3-70b-versatile"
 VOICE = "en-US-AndrewMultilingualNeural"  # Natural male English voice
 AUDIO_DIR = "/pipeline/audio"
+EDGE_TTS = shutil.which("edge-tts") or "edge-tts"
+TTS_JOBS = int(os.environ.get("TTS_JOBS", "4"))  # concurrent edge-tts requests
 
 
 def generate_script(clips: list, groq_api_key: str) -> dict:
@@ -81,8 +87,8 @@ Rules:
 
     print("  Generating narration script via Groq...", file=sys.stderr)
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            data = json.loads(resp.read().decode())
+        with open_url(req, timeout=60) as resp:
+            data = json.loads(resp.read())
             content = data["choices"][0]["message"]["content"]
             return json.loads(content)
     except Exception as e:
@@ -120,15 +126,14 @@ def _fallback_script(clips: list) -> dict:
 def generate_audio(text: str, output_path: str, voice: str = VOICE) -> bool:
     """Generate audio from text using edge-tts."""
     cmd = [
-        "edge-tts",
+        EDGE_TTS,
         "--voice", voice,
         "--text", text,
         "--write-media", output_path,
-        "--write-subtitles", output_path.replace(".mp3", ".vtt"),
     ]
 
     try:
-        subprocess.run(cmd, capture_output=True, timeout=60, check=True)
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60, check=True)
         return True
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         print(f"  [ERR] edge-tts failed: {e}", file=sys.stderr)
@@ -136,38 +141,41 @@ def generate_audio(text: str, output_path: str, voice: str = VOICE) -> bool:
 
 
 def generate_all_audio(script: dict, audio_dir: str = AUDIO_DIR) -> dict:
-    """Generate all audio files for the narration."""
+    """Generate all audio files for the narration.
+
+    Every utterance is an independent network round trip to Edge TTS, so
+    they all run side by side (TTS_JOBS at a time) rather than in sequence.
+    """
     os.makedirs(audio_dir, exist_ok=True)
-    audio_files = {}
 
-    # Intro
+    # (text, output_path) for intro, each clip's before/after, and outro
     intro_path = os.path.join(audio_dir, "intro.mp3")
-    if generate_audio(script["intro_narration"], intro_path):
-        audio_files["intro"] = intro_path
-
-    # Per-clip narrations
-    audio_files["clips"] = []
+    outro_path = os.path.join(audio_dir, "outro.mp3")
+    jobs = [(script["intro_narration"], intro_path)]
+    clip_paths = []
     for clip_data in script.get("clips", []):
         clip_num = clip_data["clip_number"]
-        clip_audio = {}
-
-        before_text = clip_data.get("narration_before", "")
-        if before_text:
-            before_path = os.path.join(audio_dir, f"clip_{clip_num}_before.mp3")
-            if generate_audio(before_text, before_path):
-                clip_audio["before"] = before_path
+        paths = {}
+        for key in ("before", "after"):
+            text = clip_data.get(f"narration_{key}", "")
+            if text:
+                paths[key] = os.path.join(audio_dir, f"clip_{clip_num}_{key}.mp3")
+                jobs.append((text, paths[key]))
+        clip_paths.append(paths)
+    jobs.append((script["outro_narration"], outro_path))
+
+    with ThreadPoolExecutor(max_workers=max(1, TTS_JOBS)) as pool:
+        ok = dict(zip((path for _, path in jobs),
+                      pool.map(lambda job: generate_audio(*job), jobs)))
 
-        after_text = clip_data.get("narration_after", "")
-        if after_text:
-            after_path = os.path.join(audio_dir, f"clip_{clip_num}_after.mp3")
-            if generate_audio(after_text, after_path):
-                clip_audio["after"] = after_path
-
-        audio_files["clips"].append(clip_audio)
-
-    # Outro
-    outro_path = os.path.join(audio_dir, "outro.mp3")
-    if generate_audio(script["outro_narration"], outro_path):
+    audio_files = {}
+    if ok[intro_path]:
+        audio_files["intro"] = intro_path
+    audio_files["clips"] = [
+        {key: path for key, path in paths.items() if ok[path]}
+        for paths in clip_paths
+    ]
+    if ok[outro_path]:
         audio_files["outro"] = outro_path
 
     print(f"  Generated audio files in {audio_dir}", file=sys.stderr)
@@ -195,11 +203,11 @@ if __name__ == "__main__":
     script_path = os.path.join(audio_dir, "script.json")
     os.makedirs(audio_dir, exist_ok=True)
     with open(script_path, "w") as f:
-        json.dump(script, f, indent=2)
+        f.write(json.dumps(script, indent=2))
     print(f"  Script saved to {script_path}", file=sys.stderr)
 
     # Generate audio
     audio_files = generate_all_audio(script, audio_dir)
     audio_manifest = os.path.join(audio_dir, "audio_manifest.json")
     with open(audio_manifest, "w") as f:
-        json.dump(audio_files, f, indent=2)
+        f.write(json.dumps(audio_files, indent=2))
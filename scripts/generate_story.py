@@ -4,31 +4,115 @@ Scrape trending Reddit posts and adapt them into viral YouTube Shorts scripts.
 Uses Reddit JSON API (free, no key) + Groq for adaptation.
 """
 
+import email.utils
+import hashlib
 import json
 import os
 import sys
+import tempfile
+import urllib.error
 import urllib.request
 import urllib.parse
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from http_utils import TokenBucket, open_url
 
 GROQ_MODEL = "llama-3.3-70b-versatile"
 BROWSER_UA = "Mozilla/5.0 (X11; Linux aarch64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 MAX_RETRIES = 3
-RETRY_DELAY = 10  # seconds
-
-
-def _call_groq(groq_api_key: str, prompt: str, temperature: float = 0.85) -> dict:
-    """Call Groq API with retry logic. Returns parsed JSON or None."""
-    body = json.dumps({
+RETRY_DELAY = 2  # seconds before the first retry, doubling after each failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # other HTTP errors won't fix themselves
+# Output budget per request: a short (150-word narration, 4 detailed scene
+# prompts, title/description/tags) is ~600 tokens, so this leaves headroom
+TOKENS_PER_SHORT = 900
+TOKENS_OVERHEAD = 300
+REDDIT_JOBS = int(os.environ.get("REDDIT_JOBS", "4"))  # concurrent subreddit fetches
+# Starts per second across all fetch threads (bursts up to the same number)
+REDDIT_RATE = float(os.environ.get("REDDIT_RATE", "4"))
+# "Top of the week" barely moves within an hour; reuse listings (and the shorts
+# adapted from an identical set of posts) for this long. 0 disables the cache.
+CACHE_DIR = os.environ.get("REDDIT_CACHE_DIR", "/pipeline/cache/reddit")
+CACHE_TTL = int(os.environ.get("REDDIT_CACHE_TTL", "1800"))  # seconds
+
+
+# Fields every validated short has, with the type (and empty default) they must have
+SHORT_FIELDS = {
+    "title": "",
+    "description": "",
+    "tags": [],
+    "niche": "",
+    "narration": "",
+    "hook_text": "",
+    "source_subreddit": "",
+}
+
+
+def _validate_shorts(data) -> dict:
+    """Check a reply has the shorts schema and normalise it (ValueError if unusable).
+
+    Every returned short has all SHORT_FIELDS with the right types, a
+    non-empty narration, and `scenes` as a list of {"visual_prompt": str}, so
+    callers can index it directly.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("shorts"), list):
+        raise ValueError("reply has no shorts list")
+
+    shorts = []
+    for raw in data["shorts"]:
+        if not isinstance(raw, dict):
+            continue
+        short = dict(raw)
+        for key, default in SHORT_FIELDS.items():
+            if not isinstance(short.get(key), type(default)):
+                short[key] = type(default)()
+        short["tags"] = [tag for tag in short["tags"] if isinstance(tag, str)]
+
+        scenes = []
+        for scene in raw.get("scenes") if isinstance(raw.get("scenes"), list) else []:
+            # Accept both {"visual_prompt": "..."} and plain string scenes
+            prompt = scene.get("visual_prompt") if isinstance(scene, dict) else scene
+            if isinstance(prompt, str) and prompt.strip():
+                scenes.append({"visual_prompt": prompt})
+        short["scenes"] = scenes
+
+        if short["narration"].strip():
+            shorts.append(short)
+
+    if not shorts:
+        raise ValueError("reply has no usable shorts")
+    return {**data, "shorts": shorts}
+
+
+def _shorts_max_tokens(count: int) -> int:
+    """Output budget for `count` shorts: JSON wrapper plus one short's worth each."""
+    return TOKENS_OVERHEAD + TOKENS_PER_SHORT * count
+
+
+def _call_groq(groq_api_key: str, prompt: str, temperature: float = 0.85,
+               system: str = None, max_tokens: int = 4000, validate=None) -> dict:
+    """Call Groq API with retry logic. Returns parsed JSON or None.
+
+    A constant `system` prompt keeps the request prefix identical across
+    runs, so Groq can serve it from its prompt cache. If a reply is cut off
+    at `max_tokens`, the retry gets twice the budget. `validate` (parsed
+    reply -> cleaned reply, raising ValueError) makes a malformed reply
+    count as a failed attempt.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    payload = {
         "model": GROQ_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "temperature": temperature,
-        "max_tokens": 4000,
+        "max_tokens": max_tokens,
         "response_format": {"type": "json_object"},
-    }).encode()
+    }
 
     for attempt in range(1, MAX_RETRIES + 1):
+        body = json.dumps(payload).encode()
         req = urllib.request.Request(
             "https://api.groq.com/openai/v1/chat/completions",
             data=body,
@@ -40,17 +124,33 @@ def _call_groq(groq_api_key: str, prompt: str, temperature: float = 0.85) -> dic
             },
         )
         try:
-            with urllib.request.urlopen(req, timeout=90) as resp:
-                data = json.loads(resp.read().decode())
-                content = data["choices"][0]["message"]["content"]
-                return json.loads(content)
+            with open_url(req, timeout=90) as resp:
+                data = json.loads(resp.read())
+                usage = data.get("usage") or {}
+                cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+                if cached is not None and usage.get("prompt_tokens"):
+                    print(f"  Groq prompt cache: {cached}/{usage['prompt_tokens']} tokens",
+                          file=sys.stderr)
+                choice = data["choices"][0]
+                if choice.get("finish_reason") == "length":
+                    limit = payload["max_tokens"]
+                    payload["max_tokens"] = limit * 2
+                    raise ValueError(f"reply truncated at {limit} tokens")
+                parsed = json.loads(choice["message"]["content"])
+                return validate(parsed) if validate else parsed
         except Exception as e:
             print(f"  [WARN] Groq attempt {attempt}/{MAX_RETRIES} failed: {e}",
                   file=sys.stderr)
+            if isinstance(e, urllib.error.HTTPError) and e.code not in RETRY_STATUSES:
+                break
             if attempt < MAX_RETRIES:
-                print(f"  Retrying in {RETRY_DELAY}s...", file=sys.stderr)
-                time.sleep(RETRY_DELAY)
-    print(f"  [ERR] Groq failed after {MAX_RETRIES} attempts", file=sys.stderr)
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                retry_after = e.headers.get("Retry-After", "") if isinstance(e, urllib.error.HTTPError) else ""
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                print(f"  Retrying in {delay}s...", file=sys.stderr)
+                time.sleep(delay)
+    print(f"  [ERR] Groq failed after {attempt} attempt(s)", file=sys.stderr)
     return None
 
 # Subreddits to scrape (sorted by virality potential)
@@ -68,59 +168,130 @@ SUBREDDITS = [
 
 def scrape_reddit(subreddits: list = None, time_filter: str = "week",
                    limit: int = 5) -> list:
-    """Scrape top posts from Reddit (no API key needed)."""
+    """Scrape top posts from Reddit (no API key needed).
+
+    Subreddits are fetched concurrently; REDDIT_JOBS caps how many requests
+    are in flight at once so we stay polite to Reddit.
+    """
     if not subreddits:
         subreddits = random.sample(SUBREDDITS, min(4, len(SUBREDDITS)))
 
-    posts = []
-    for sub in subreddits:
-        url = f"https://www.reddit.com/r/{sub}/top.json?t={time_filter}&limit={limit}"
-        req = urllib.request.Request(url, headers={
-            "User-Agent": BROWSER_UA,
-            "Accept": "application/json",
-        })
-        try:
-            with urllib.request.urlopen(req, timeout=15) as resp:
-                data = json.loads(resp.read().decode())
-                for child in data.get("data", {}).get("children", []):
-                    post = child.get("data", {})
-                    text = post.get("selftext", "")
-                    if len(text) > 200:  # Only posts with substantial text
-                        posts.append({
-                            "subreddit": sub,
-                            "title": post.get("title", ""),
-                            "text": text[:3000],  # Cap at 3000 chars
-                            "score": post.get("score", 0),
-                            "num_comments": post.get("num_comments", 0),
-                            "url": f"https://reddit.com{post.get('permalink', '')}",
-                        })
-            time.sleep(1)  # Be nice to Reddit
-        except Exception as e:
-            print(f"  [WARN] Reddit r/{sub} failed: {e}", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, REDDIT_JOBS)) as pool:
+        per_sub = pool.map(lambda sub: _fetch_subreddit(sub, time_filter, limit), subreddits)
+        posts = [post for sub_posts in per_sub for post in sub_posts]
 
     # Sort by engagement (score + comments)
     posts.sort(key=lambda p: p["score"] + p["num_comments"] * 2, reverse=True)
     return posts
 
 
-def adapt_stories(groq_api_key: str, reddit_posts: list, count: int = 3) -> dict:
-    """Use Groq to adapt Reddit posts into viral Short scripts."""
+_reddit_bucket = TokenBucket(REDDIT_RATE, max(1.0, REDDIT_RATE))
 
-    # Pick top posts
-    selected = reddit_posts[:count]
 
-    posts_text = ""
-    for i, post in enumerate(selected):
-        posts_text += f"""
---- REDDIT POST {i+1} (r/{post['subreddit']}, {post['score']} upvotes) ---
-Title: {post['title']}
-Story: {post['text'][:1500]}
----
-"""
+def _reddit_get(req: urllib.request.Request, timeout: float):
+    """open_url for Reddit, paced by the shared token bucket."""
+    _reddit_bucket.acquire()
+    return open_url(req, timeout=timeout)
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, hashlib.sha256(key.encode()).hexdigest()[:32] + ".json")
+
 
-    prompt = f"""You are a viral YouTube Shorts scriptwriter. Adapt these REAL trending Reddit posts into dramatic YouTube Shorts scripts.
+def _cache_read(path: str) -> bytes | None:
+    """Cached bytes if the entry is younger than CACHE_TTL, else None."""
+    try:
+        if time.time() - os.stat(path).st_mtime >= CACHE_TTL:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
 
-{posts_text}
+
+def _cache_write(path: str, data: bytes):
+    """Atomically store a cache entry (best effort: no cache dir, no caching)."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def _cached_get(req: urllib.request.Request, timeout: float) -> bytes:
+    """GET through the disk cache.
+
+    Fresh entries are returned without touching the network; stale ones are
+    revalidated with If-Modified-Since, and a 304 just renews the entry.
+    """
+    if CACHE_TTL <= 0:
+        with _reddit_get(req, timeout) as resp:
+            return resp.read()
+
+    path = _cache_path(req.full_url)
+    cached = _cache_read(path)
+    if cached is not None:
+        return cached
+
+    try:
+        mtime = os.stat(path).st_mtime
+        req.add_header("If-Modified-Since", email.utils.formatdate(mtime, usegmt=True))
+    except OSError:
+        mtime = None
+
+    with _reddit_get(req, timeout) as resp:
+        body = resp.read()
+        not_modified = resp.status == 304
+    if not_modified and mtime is not None:
+        try:
+            os.utime(path)
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            pass
+        # Entry vanished under us; ask again without the validator
+        del req.headers["If-modified-since"]
+        with _reddit_get(req, timeout) as resp:
+            body = resp.read()
+
+    _cache_write(path, body)
+    return body
+
+
+def _fetch_subreddit(sub: str, time_filter: str, limit: int) -> list:
+    """Top text posts from one subreddit ([] on failure)."""
+    url = f"https://www.reddit.com/r/{sub}/top.json?t={time_filter}&limit={limit}"
+    req = urllib.request.Request(url, headers={
+        "User-Agent": BROWSER_UA,
+        "Accept": "application/json",
+    })
+    posts = []
+    try:
+        data = json.loads(_cached_get(req, timeout=15))
+        for child in data.get("data", {}).get("children", []):
+            post = child.get("data", {})
+            text = post.get("selftext") or ""
+            if len(text) <= 200:  # Only posts with substantial text
+                continue
+            posts.append({
+                "subreddit": sub,
+                "title": post.get("title", ""),
+                "text": text[:3000],  # Cap at 3000 chars
+                "score": post.get("score", 0),
+                "num_comments": post.get("num_comments", 0),
+                "url": f"https://reddit.com{post.get('permalink', '')}",
+            })
+    except Exception as e:
+        print(f"  [WARN] Reddit r/{sub} failed: {e}", file=sys.stderr)
+    return posts
+
+
+# Instructions + schema for adapt_stories. Kept constant (posts go in the user
+# message) so the prefix is byte-identical across runs and Groq can cache it.
+ADAPT_SYSTEM_PROMPT = """You are a viral YouTube Shorts scriptwriter. The user sends REAL trending Reddit posts labeled POST_1, POST_2, ... Adapt them into dramatic YouTube Shorts scripts.
 
 For EACH post, create a Short script:
 
@@ -134,41 +305,77 @@ Rules:
 - DO NOT copy the Reddit text directly - rewrite it dramatically
 
 Return JSON:
-{{
+{
   "shorts": [
-    {{
+    {
+      "id": "POST_N label of the post this short adapts",
       "title": "catchy YouTube title under 60 chars, use 1-2 CAPS words for impact",
       "description": "YouTube description with hashtags #aita #reddit #storytime #drama #plottwist",
       "tags": ["storytime", "reddit", "aita", "revenge", "plottwist", "drama", "viral", "shorts"],
       "niche": "aita/revenge/plottwist/entitled/drama",
       "narration": "THE REWRITTEN STORY. 120-150 words. First person. Dramatic. Hook first.",
       "scenes": [
-        {{"visual_prompt": "close up portrait of [person: age, gender, hair color/style, specific facial expression], [specific indoor/outdoor setting with details], soft directional lighting, shallow depth of field, cinematic photography"}},
-        {{"visual_prompt": "[specific action scene], [camera angle: low/overhead/medium shot], [specific setting with objects], dramatic side lighting, moody atmosphere, cinematic photography"}},
-        {{"visual_prompt": "[confrontation or key moment between characters], [specific setting], dramatic lighting, tense body language, cinematic photography"}},
-        {{"visual_prompt": "[resolution/emotional aftermath scene], [setting with time-of-day lighting], contemplative mood, cinematic composition"}}
+        {"visual_prompt": "close up portrait of [person: age, gender, hair color/style, specific facial expression], [specific indoor/outdoor setting with details], soft directional lighting, shallow depth of field, cinematic photography"},
+        {"visual_prompt": "[specific action scene], [camera angle: low/overhead/medium shot], [specific setting with objects], dramatic side lighting, moody atmosphere, cinematic photography"},
+        {"visual_prompt": "[confrontation or key moment between characters], [specific setting], dramatic lighting, tense body language, cinematic photography"},
+        {"visual_prompt": "[resolution/emotional aftermath scene], [setting with time-of-day lighting], contemplative mood, cinematic composition"}
       ],
       "hook_text": "2-4 word overlay (AM I WRONG?, WAIT FOR IT, SWEET REVENGE, PLOT TWIST, THE AUDACITY)",
       "source_subreddit": "subreddit name"
-    }}
+    }
   ]
-}}
+}
 
 IMPORTANT for visual_prompt: Write each as a DETAILED cinematic photography description. Include specific subjects (age, gender, hair, clothing, expression), specific settings (room type, furniture, time of day), and lighting details. Example: "close up portrait of a 28 year old woman with long brown hair, shocked expression, sitting at a wooden kitchen table, warm overhead pendant light, dim evening atmosphere, shallow depth of field, cinematic photography" - NOT generic descriptions.
 
 CRITICAL: Each narration must be 120-150 words. Not less, not more.
 Return ONLY valid JSON."""
 
+
+def adapt_stories(groq_api_key: str, reddit_posts: list, count: int = 3) -> dict:
+    """Use Groq to adapt Reddit posts into viral Short scripts (one call for all)."""
+
+    # Pick top posts
+    selected = reddit_posts[:count]
+
+    posts_text = "".join(f"""
+--- POST_{i+1} (r/{post['subreddit']}, {post['score']} upvotes) ---
+Title: {post['title']}
+Story: {post['text'][:1500]}
+---
+""" for i, post in enumerate(selected))
+
+    # Same trending posts as a recent run: reuse its shorts instead of paying Groq again
+    cache_path = _cache_path("adapt:" + GROQ_MODEL + ":" + " ".join(p["url"] for p in selected))
+    cached = _cache_read(cache_path) if CACHE_TTL > 0 else None
+    if cached is not None:
+        try:
+            stories = _validate_shorts(json.loads(cached))
+            print("  Reusing cached adaptation for these posts", file=sys.stderr)
+            return stories
+        except ValueError:
+            pass
+
     print("  Adapting stories via Groq...", file=sys.stderr)
-    stories = _call_groq(groq_api_key, prompt, temperature=0.85)
+    stories = _call_groq(groq_api_key, posts_text, temperature=0.85,
+                         system=ADAPT_SYSTEM_PROMPT,
+                         max_tokens=_shorts_max_tokens(len(selected)),
+                         validate=_validate_shorts)
     if stories:
-        shorts = stories.get("shorts", [])
+        shorts = stories["shorts"]
+        # Align each short back to its source post by label
+        by_id = {f"POST_{i+1}": post for i, post in enumerate(selected)}
+        for s in shorts:
+            post = by_id.get(str(s.get("id", "")).upper())
+            if post:
+                s["source_subreddit"] = post["subreddit"]
         print(f"  Adapted {len(shorts)} shorts", file=sys.stderr)
         for i, s in enumerate(shorts):
-            words = len(s.get("narration", "").split())
-            scenes = len(s.get("scenes", []))
-            print(f"    Short {i+1}: '{s.get('title', '?')[:45]}' ({words}w, {scenes} scenes)",
+            words = len(s["narration"].split())
+            print(f"    Short {i+1}: '{(s['title'] or '?')[:45]}' ({words}w, {len(s['scenes'])} scenes)",
                   file=sys.stderr)
+        if shorts and CACHE_TTL > 0:
+            _cache_write(cache_path, json.dumps(stories).encode())
     return stories
 
 
@@ -193,41 +400,30 @@ def generate_story(groq_api_key: str, niche: str = None, count: int = 3) -> dict
     return adapt_stories(groq_api_key, posts, count)
 
 
-def _generate_original(groq_api_key: str, count: int = 3) -> dict:
-    """Fallback: generate original stories if Reddit scraping fails."""
-    niches = [
-        "AITA - shocking family/relationship conflict with a twist ending",
-        "Revenge - clever satisfying payback story",
-        "Plot Twist - normal situation that takes an insane unexpected turn",
-    ]
-    selected = random.sample(niches, min(count, len(niches)))
-    niche_list = "\n".join(f"- Story {i+1}: {n}" for i, n in enumerate(selected))
-
-    prompt = f"""Generate {count} viral YouTube Shorts stories. 120-150 words each narration.
-
-Niches:
-{niche_list}
+# Instructions + schema for _generate_original, constant for the same prompt
+# caching reason as ADAPT_SYSTEM_PROMPT; only the niche list varies per call.
+ORIGINAL_SYSTEM_PROMPT = """You are a viral YouTube Shorts scriptwriter. The user asks for a number of stories and gives a niche for each. Write them as YouTube Shorts scripts, 120-150 words of narration each.
 
 Return JSON:
-{{
+{
   "shorts": [
-    {{
+    {
       "title": "catchy YouTube title under 60 chars, use 1-2 CAPS words",
       "description": "YouTube description with hashtags #aita #reddit #storytime #drama #plottwist",
       "tags": ["storytime", "reddit", "aita", "revenge", "plottwist", "drama", "viral", "shorts"],
       "niche": "aita/revenge/plottwist",
       "narration": "THE STORY. 120-150 words. First person. Dramatic hook first. Casual tone.",
       "scenes": [
-        {{"visual_prompt": "close up portrait of [person: age, gender, hair, expression], [specific setting], soft directional lighting, shallow depth of field, cinematic photography"}},
-        {{"visual_prompt": "[specific action scene], [camera angle], [setting with objects], dramatic side lighting, cinematic photography"}},
-        {{"visual_prompt": "[confrontation between characters], [specific setting], dramatic lighting, tense body language, cinematic photography"}},
-        {{"visual_prompt": "[resolution scene], [setting with time-of-day lighting], contemplative mood, cinematic composition"}}
+        {"visual_prompt": "close up portrait of [person: age, gender, hair, expression], [specific setting], soft directional lighting, shallow depth of field, cinematic photography"},
+        {"visual_prompt": "[specific action scene], [camera angle], [setting with objects], dramatic side lighting, cinematic photography"},
+        {"visual_prompt": "[confrontation between characters], [specific setting], dramatic lighting, tense body language, cinematic photography"},
+        {"visual_prompt": "[resolution scene], [setting with time-of-day lighting], contemplative mood, cinematic composition"}
       ],
       "hook_text": "2-4 word overlay like AM I WRONG? or PLOT TWIST",
       "source_subreddit": "reddit"
-    }}
+    }
   ]
-}}
+}
 
 Make stories feel REAL like Reddit posts. Dramatic hooks. Shocking twists.
 IMPORTANT: Write each visual_prompt as a DETAILED cinematic photography description with specific subjects, settings, and lighting. Example: "close up portrait of a 25 year old man with black hair looking at his phone, blue glow on face, dimly lit bedroom, shallow depth of field, cinematic photography" - NOT generic descriptions.
@@ -241,7 +437,26 @@ CRITICAL RULES:
 6. Each scene visual_prompt must be a detailed cinematic description.
 Return ONLY valid JSON."""
 
-    return _call_groq(groq_api_key, prompt, temperature=0.9)
+
+def _generate_original(groq_api_key: str, count: int = 3) -> dict:
+    """Fallback: generate original stories if Reddit scraping fails."""
+    niches = [
+        "AITA - shocking family/relationship conflict with a twist ending",
+        "Revenge - clever satisfying payback story",
+        "Plot Twist - normal situation that takes an insane unexpected turn",
+    ]
+    selected = random.sample(niches, min(count, len(niches)))
+    niche_list = "\n".join(f"- Story {i+1}: {n}" for i, n in enumerate(selected))
+
+    prompt = f"""Generate {count} viral YouTube Shorts stories.
+
+Niches:
+{niche_list}"""
+
+    return _call_groq(groq_api_key, prompt, temperature=0.9,
+                      system=ORIGINAL_SYSTEM_PROMPT,
+                      max_tokens=_shorts_max_tokens(count),
+                      validate=_validate_shorts)
 
 
 if __name__ == "__main__":
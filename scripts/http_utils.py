@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Keep-alive HTTP for the API and download helpers.
+
+urllib.request.urlopen opens a fresh TCP + TLS connection for every request.
+open_url() is a drop-in for it that keeps one http.client connection per host
+(per thread) and reuses it, so repeated calls to the same API skip the
+handshake. It takes the same urllib.request.Request objects, follows
+redirects, and raises urllib.error.HTTPError on 4xx/5xx just like urlopen.
+A request is only sent a second time when that can't repeat its effect: the
+write to a dropped connection failed, or the method is idempotent.
+
+TokenBucket paces calls to rate-limited APIs: callers only wait when they
+have actually used up their burst, instead of sleeping after every request,
+or when pause() relays a server's Retry-After to every caller.
+"""
+
+import http.client
+import select
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+MAX_REDIRECTS = 5
+# Safe to resend after the request went out but no reply came back. A POST
+# (an LLM completion, a TikTok init, an Instagram publish) is never replayed.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT"}
+
+_local = threading.local()
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._resume = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping only if the bucket is empty (or paused)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            wait = max(wait, self._resume - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold every caller for `seconds`, e.g. when the server says Retry-After."""
+        with self._lock:
+            self._resume = max(self._resume, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+
+def retry_after(err: urllib.error.HTTPError) -> float | None:
+    """Seconds a 429/503 response asks us to wait (Retry-After), or None."""
+    value = (err.headers or {}).get("Retry-After", "")
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _connection(scheme: str, host: str, timeout: float,
+                fresh: bool = False) -> http.client.HTTPConnection:
+    """The calling thread's open connection to scheme://host, created on first use.
+
+    fresh=True closes any kept-alive socket first, so the request goes out on
+    a brand new connection.
+    """
+    if not hasattr(_local, "conns"):
+        _local.conns = {}
+    conn = _local.conns.get((scheme, host))
+    if conn is not None and fresh:
+        conn.close()
+    elif conn is not None and conn.last_response and not conn.last_response.isclosed():
+        # The previous body was never fully read; its bytes would corrupt the
+        # next exchange, so start over on a new socket
+        conn.close()
+    elif conn is not None and conn.sock and select.select([conn.sock], [], [], 0)[0]:
+        # An idle keep-alive socket is only readable once the server has
+        # closed it; reconnect now rather than find out after sending
+        conn.close()
+    if conn is None:
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        conn = cls(host, timeout=timeout)
+        conn.last_response = None
+        _local.conns[(scheme, host)] = conn
+    conn.timeout = timeout
+    if conn.sock:
+        conn.sock.settimeout(timeout)
+    return conn
+
+
+def _send(req: urllib.request.Request, timeout: float,
+          fresh: bool = False) -> http.client.HTTPResponse:
+    parts = urllib.parse.urlsplit(req.full_url)
+    path = parts.path or "/"
+    if parts.query:
+        path = f"{path}?{parts.query}"
+    headers = dict(req.header_items())
+    if req.data is not None and "Content-type" not in headers:
+        headers["Content-type"] = "application/x-www-form-urlencoded"
+
+    method = req.get_method()
+    conn = _connection(parts.scheme, parts.netloc, timeout, fresh)
+    reused = conn.sock is not None
+    try:
+        try:
+            conn.request(method, path, body=req.data, headers=headers)
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped the idle connection before the request was
+            # written, so nothing reached it; send it once on a fresh socket
+            reused = False
+            conn.request(method, path, body=req.data, headers=headers)
+        try:
+            conn.last_response = conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused or method not in IDEMPOTENT_METHODS:
+                raise
+            # The request went out but no reply came; only an idempotent one
+            # can be sent again without risking doing it twice
+            conn.request(method, path, body=req.data, headers=headers)
+            conn.last_response = conn.getresponse()
+    except OSError:
+        conn.close()
+        raise
+    return conn.last_response
+
+
+def open_url(req, timeout: float = 30, fresh: bool = False) -> http.client.HTTPResponse:
+    """urlopen() over a reused keep-alive connection.
+
+    Use the response like urlopen's (read() it, or use it as a context
+    manager). A body left unread costs the connection, not correctness.
+    fresh=True sends over a new connection, for one-shot calls that must not
+    be repeated and may follow a long idle (nothing to resend, nothing stale).
+    """
+    if isinstance(req, str):
+        req = urllib.request.Request(req)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        resp = _send(req, timeout, fresh)
+        location = resp.getheader("Location")
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            resp.read()
+            url = urllib.parse.urljoin(req.full_url, location)
+            if resp.status in (307, 308):
+                req = urllib.request.Request(url, data=req.data, headers=req.headers,
+                                             method=req.get_method())
+            else:
+                req = urllib.request.Request(url, headers={
+                    k: v for k, v in req.headers.items() if k.lower() != "content-type"
+                })
+            continue
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(req.full_url, resp.status, resp.reason,
+                                         resp.headers, resp)
+        return resp
+
+    raise urllib.error.HTTPError(req.full_url, resp.status, "Too many redirects",
+                                 resp.headers, resp)
@@ -6,18 +6,29 @@ Returns per-segment audio files with durations.
 
 import json
 import os
+import re
 import subprocess
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_utils import mp3_duration
+from ffmpeg_utils import FFPROBE
 
 VOICE = "en-US-AndrewMultilingualNeural"
 AUDIO_DIR = "/pipeline/audio"
+EDGE_TTS = shutil.which("edge-tts") or "edge-tts"
+TTS_JOBS = int(os.environ.get("TTS_JOBS", "4"))  # concurrent edge-tts requests
 
 
 def get_audio_duration(filepath: str) -> float:
-    """Get audio file duration using ffprobe."""
+    """Get audio file duration from its MP3 headers, falling back to ffprobe."""
+    duration = mp3_duration(filepath)
+    if duration is not None:
+        return duration
     try:
         result = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
+            [FFPROBE, "-v", "quiet", "-show_entries", "format=duration",
              "-of", "csv=p=0", filepath],
             capture_output=True, text=True, timeout=30
         )
@@ -33,7 +44,7 @@ def generate_segment_audio(text: str, output_path: str, voice: str = VOICE) -> f
 
     sub_path = output_path.replace(".mp3", ".vtt")
     cmd = [
-        "edge-tts",
+        EDGE_TTS,
         "--voice", voice,
         "--text", text,
         "--write-media", output_path,
@@ -51,83 +62,86 @@ def generate_segment_audio(text: str, output_path: str, voice: str = VOICE) -> f
 
 def narrate_all_segments(segments: list, audio_dir: str = AUDIO_DIR,
                           voice: str = VOICE) -> list:
-    """Generate audio for all story segments. Returns updated segments with durations."""
+    """Generate audio for all story segments. Returns updated segments with durations.
+
+    Segments are independent TTS round trips, so they run TTS_JOBS at a time;
+    each worker probes its own file, overlapping probes with later requests.
+    """
     os.makedirs(audio_dir, exist_ok=True)
 
-    total_duration = 0
     for seg in segments:
         seg_num = seg.get("segment_number", 0)
-        text = seg.get("narration", "")
-        audio_path = os.path.join(audio_dir, f"seg_{seg_num}.mp3")
-        sub_path = os.path.join(audio_dir, f"seg_{seg_num}.vtt")
+        seg["audio_path"] = os.path.join(audio_dir, f"seg_{seg_num}.mp3")
+        seg["subtitle_path"] = os.path.join(audio_dir, f"seg_{seg_num}.vtt")
 
-        duration = generate_segment_audio(text, audio_path, voice)
-        seg["audio_path"] = audio_path
-        seg["subtitle_path"] = sub_path
+    def narrate_one(seg):
+        return generate_segment_audio(seg.get("narration", ""), seg["audio_path"], voice)
+
+    with ThreadPoolExecutor(max_workers=max(1, TTS_JOBS)) as pool:
+        durations = list(pool.map(narrate_one, segments))
+
+    total_duration = 0
+    for seg, duration in zip(segments, durations):
         seg["audio_duration"] = duration
+        seg["audio_duration_ms"] = round(duration * 1000)
         total_duration += duration
-
         if duration > 0:
-            print(f"    Segment {seg_num}: {duration:.1f}s", file=sys.stderr)
+            print(f"    Segment {seg.get('segment_number', 0)}: {duration:.1f}s", file=sys.stderr)
 
     print(f"  Total narration: {total_duration:.0f}s ({total_duration/60:.1f} min)", file=sys.stderr)
     return segments
 
 
+# "start --> end" on a cue line; hours are optional in VTT
+_CUE_TIMES_RE = re.compile(
+    rb"(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})[ \t]*-->[ \t]*(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})"
+)
+_HEADER_RE = re.compile(rb"\A(?:\xef\xbb\xbf)?WEBVTT[^\n]*\n")
+
+
 def generate_full_subtitles(segments: list, output_path: str):
-    """Merge all segment VTT files into one continuous subtitle file."""
-    offset = 0.0
-    lines = ["WEBVTT", ""]
+    """Merge all segment VTT files into one continuous subtitle file.
 
-    for seg in segments:
-        vtt_path = seg.get("subtitle_path", "")
-        duration = seg.get("audio_duration", 0)
+    Each file gets one regex pass that shifts its cue times by the running
+    offset, in integer milliseconds so nothing drifts across segments.
+    """
+    offset_ms = 0
+    chunks = [b"WEBVTT\n\n"]
 
-        if not vtt_path or not os.path.exists(vtt_path):
-            offset += duration
-            continue
+    def shift(match):
+        start = _vtt_ms(*match.group(1, 2, 3, 4)) + offset_ms
+        end = _vtt_ms(*match.group(5, 6, 7, 8)) + offset_ms
+        return _format_vtt_ms(start) + b" --> " + _format_vtt_ms(end)
 
-        with open(vtt_path) as f:
-            content = f.read()
+    for seg in segments:
+        vtt_path = seg.get("subtitle_path", "")
+        duration_ms = seg.get("audio_duration_ms")
+        if duration_ms is None:
+            duration_ms = round(seg.get("audio_duration", 0) * 1000)
 
-        for line in content.split("\n"):
-            if "-->" in line:
-                # Parse timestamps and add offset
-                parts = line.split(" --> ")
-                if len(parts) == 2:
-                    start = _parse_vtt_time(parts[0]) + offset
-                    end = _parse_vtt_time(parts[1]) + offset
-                    lines.append(f"{_format_vtt_time(start)} --> {_format_vtt_time(end)}")
-            elif line.strip() and line.strip() != "WEBVTT":
-                lines.append(line)
+        if vtt_path and os.path.exists(vtt_path):
+            with open(vtt_path, "rb") as f:
+                content = f.read().replace(b"\r\n", b"\n")
+            body = _HEADER_RE.sub(b"", content, count=1).strip(b"\n")
+            if body:
+                chunks.append(_CUE_TIMES_RE.sub(shift, body) + b"\n\n")
 
-        offset += duration
+        offset_ms += duration_ms
 
-    with open(output_path, "w") as f:
-        f.write("\n".join(lines))
+    with open(output_path, "wb") as f:
+        f.write(b"".join(chunks))
 
     return output_path
 
 
-def _parse_vtt_time(time_str: str) -> float:
-    """Parse VTT timestamp to seconds."""
-    time_str = time_str.strip().replace(",", ".")
-    parts = time_str.split(":")
-    if len(parts) == 3:
-        h, m, s = parts
-        return int(h) * 3600 + int(m) * 60 + float(s)
-    elif len(parts) == 2:
-        m, s = parts
-        return int(m) * 60 + float(s)
-    return 0
+def _vtt_ms(h, m, s, ms) -> int:
+    """VTT timestamp fields (bytes, hours may be None) to integer milliseconds."""
+    return ((int(h or 0) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
 
 
-def _format_vtt_time(seconds: float) -> str:
-    """Format seconds to VTT timestamp."""
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    s = seconds % 60
-    return f"{h:02d}:{m:02d}:{s:06.3f}"
+def _format_vtt_ms(ms: int) -> bytes:
+    """Integer milliseconds to a VTT timestamp."""
+    return b"%02d:%02d:%02d.%03d" % (ms // 3_600_000, ms // 60_000 % 60, ms // 1000 % 60, ms % 1000)
 
 
 if __name__ == "__main__":
@@ -143,4 +157,4 @@ if __name__ == "__main__":
 
     # Save updated story with audio paths
     with open(sys.argv[1], "w") as f:
-        json.dump({**story, "segments": segments}, f, indent=2)
+        f.write(json.dumps({**story, "segments": segments}, indent=2))
@@ -77,7 +77,7 @@ def run_pipeline() -> dict:
         # Save script for reference
         script_path = os.path.join(AUDIO_DIR, "script.json")
         with open(script_path, "w") as f:
-            json.dump(script, f, indent=2)
+            f.write(json.dumps(script, indent=2))
 
         # Step 4: Compile video
         print("\n[4/5] Compiling video...", file=sys.stderr)
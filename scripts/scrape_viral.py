@@ -4,21 +4,25 @@ Scrape viral videos from multiple sources that work from cloud IPs.
 No Reddit API needed - uses yt-dlp extractors and public feeds.
 """
 
+import heapq
 import json
 import sys
 import subprocess
 import os
-import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 TOTAL_CLIPS = 10
+YT_DLP = shutil.which("yt-dlp") or "yt-dlp"
 
 
 def fetch_youtube_trending(limit: int = 20) -> list:
     """Fetch YouTube trending/popular videos using yt-dlp."""
     print("  Scanning YouTube Trending...", file=sys.stderr)
     cmd = [
-        "yt-dlp", "--flat-playlist", "--no-warnings",
+        YT_DLP, "--flat-playlist", "--no-warnings",
         "--dump-json", "--playlist-items", f"1:{limit}",
         "https://www.youtube.com/feed/trending",
     ]
@@ -34,15 +38,7 @@ def fetch_youtube_popular_shorts(limit: int = 20) -> list:
         "ytsearch15:funny fail compilation 2026",
         "ytsearch10:unexpected moments caught on camera",
     ]
-    results = []
-    for query in queries:
-        cmd = [
-            "yt-dlp", "--flat-playlist", "--no-warnings",
-            "--dump-json", query,
-        ]
-        results.extend(_run_ytdlp_list(cmd, f"YT Search"))
-        time.sleep(1)
-    return results
+    return _run_ytdlp_list(_search_cmd(queries), "YT Search", timeout=120 * len(queries))
 
 
 def fetch_tiktok_trending(limit: int = 15) -> list:
@@ -52,51 +48,73 @@ def fetch_tiktok_trending(limit: int = 15) -> list:
         "tiktoksearch10:viral today",
         "tiktoksearch10:funny fail",
     ]
-    results = []
-    for query in queries:
-        cmd = [
-            "yt-dlp", "--flat-playlist", "--no-warnings",
-            "--dump-json", query,
-        ]
-        batch = _run_ytdlp_list(cmd, "TikTok")
-        results.extend(batch)
-        time.sleep(1)
-    return results
+    return _run_ytdlp_list(_search_cmd(queries), "TikTok", timeout=120 * len(queries))
 
 
-def _run_ytdlp_list(cmd: list, source: str) -> list:
-    """Run yt-dlp and parse JSON lines output."""
+def _search_cmd(queries: list) -> list:
+    """One yt-dlp run for all queries: a single interpreter start-up instead of one each.
+
+    --ignore-errors keeps a failing query from dropping the rest.
+    """
+    return [
+        YT_DLP, "--flat-playlist", "--no-warnings", "--ignore-errors",
+        "--dump-json", *queries,
+    ]
+
+
+def _run_ytdlp_list(cmd: list, source: str, timeout: int = 120) -> list:
+    """Run yt-dlp and parse its JSON lines output as it streams in.
+
+    Each line is parsed as soon as yt-dlp prints it, so the full output is
+    never buffered or split; on timeout the entries read so far are kept.
+    """
     results = []
     try:
-        proc = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=120
-        )
-        for line in proc.stdout.strip().split("\n"):
-            if not line:
-                continue
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        print(f"  [WARN] {source} fetch failed: {e}", file=sys.stderr)
+        return results
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        for line in proc.stdout:
             try:
-                data = json.loads(line)
-                entry = {
-                    "id": data.get("id", ""),
-                    "subreddit": source,  # reuse field as "source"
-                    "title": data.get("title", ""),
-                    "score": data.get("view_count") or data.get("like_count") or 0,
-                    "url": data.get("url") or data.get("webpage_url", ""),
-                    "permalink": data.get("webpage_url", ""),
-                    "num_comments": data.get("comment_count") or 0,
-                    "created_utc": 0,
-                    "duration": data.get("duration") or 0,
-                }
-                # Only include videos (skip very long ones and very short)
-                dur = entry["duration"]
-                if dur and (dur < 5 or dur > 600):
-                    continue
-                if entry["url"]:
-                    results.append(entry)
+                data = json.loads(line)  # bytes straight from the pipe
             except json.JSONDecodeError:
                 continue
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
-        print(f"  [WARN] {source} fetch failed: {e}", file=sys.stderr)
+            if not isinstance(data, dict):
+                continue
+            entry = {
+                "id": data.get("id", ""),
+                "subreddit": source,  # reuse field as "source"
+                "title": data.get("title", ""),
+                "score": data.get("view_count") or data.get("like_count") or 0,
+                "url": data.get("url") or data.get("webpage_url", ""),
+                "permalink": data.get("webpage_url", ""),
+                "num_comments": data.get("comment_count") or 0,
+                "created_utc": 0,
+                "duration": data.get("duration") or 0,
+            }
+            # Only include videos (skip very long ones and very short)
+            dur = entry["duration"]
+            if dur and (dur < 5 or dur > 600):
+                continue
+            if entry["url"]:
+                results.append(entry)
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+        proc.wait()
+
+    if timed_out.is_set():
+        print(f"  [WARN] {source} fetch timed out after {timeout}s", file=sys.stderr)
 
     print(f"    Found {len(results)} from {source}", file=sys.stderr)
     return results
@@ -104,30 +122,27 @@ def _run_ytdlp_list(cmd: list, source: str) -> list:
 
 def scrape_viral(output_path: str = None) -> list:
     """Scrape viral videos from all available sources."""
-    all_posts = []
-
-    # YouTube Trending (most reliable)
-    all_posts.extend(fetch_youtube_trending())
-
-    # YouTube search for viral content
-    all_posts.extend(fetch_youtube_popular_shorts())
-
-    # TikTok (may not work from all IPs)
-    all_posts.extend(fetch_tiktok_trending())
-
-    # Sort by views/score descending
-    all_posts.sort(key=lambda x: x["score"], reverse=True)
-
-    # Deduplicate by ID
-    seen = set()
-    unique = []
+    sources = [
+        fetch_youtube_trending,        # YouTube Trending (most reliable)
+        fetch_youtube_popular_shorts,  # YouTube search for viral content
+        fetch_tiktok_trending,         # TikTok (may not work from all IPs)
+    ]
+    # Each source is one yt-dlp process waiting on the network, so run them
+    # side by side: wall time is the slowest source, not the sum (and the
+    # timeouts overlap). map keeps the source order for the ranking below.
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        all_posts = [post for batch in pool.map(lambda fetch: fetch(), sources)
+                     for post in batch]
+
+    # Deduplicate by ID first (keeping each video's best score), so only the
+    # unique posts are ranked; then take the top by views/score
+    best = {}
     for post in all_posts:
         key = post["id"]
-        if key and key not in seen:
-            seen.add(key)
-            unique.append(post)
+        if key and (key not in best or post["score"] > best[key]["score"]):
+            best[key] = post
 
-    result = unique[:TOTAL_CLIPS]
+    result = heapq.nlargest(TOTAL_CLIPS, best.values(), key=lambda x: x["score"])
 
     print(f"\n  Total: {len(result)} viral videos selected", file=sys.stderr)
     for i, p in enumerate(result):
@@ -137,7 +152,7 @@ def scrape_viral(output_path: str = None) -> list:
     if output_path:
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         with open(output_path, "w") as f:
-            json.dump(result, f, indent=2)
+            f.write(json.dumps(result, indent=2))
 
     return result
 
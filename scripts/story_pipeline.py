@@ -6,29 +6,37 @@ Flow: scrape Reddit -> adapt with Groq -> narrate -> generate AI images per scen
 
 import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, SCRIPTS_DIR)
 
-from generate_story import generate_story
-from fetch_visuals import generate_ai_image
-from assemble_video import assemble_short
+# generate_story, fetch_visuals and assemble_video are imported where they're
+# used, so a run that bails out early (no GROQ_API_KEY) doesn't load them
+from audio_utils import mp3_duration
+from ffmpeg_utils import FFPROBE
 
 BASE_DIR = "/pipeline"
 AUDIO_DIR = f"{BASE_DIR}/audio"
 VISUALS_DIR = f"{BASE_DIR}/visuals"
 OUTPUT_DIR = f"{BASE_DIR}/output"
 SHORTS_DIR = f"{BASE_DIR}/output/shorts"
+EDGE_TTS = shutil.which("edge-tts") or "edge-tts"
+IMAGE_JOBS = int(os.environ.get("IMAGE_JOBS", "4"))  # scene images requested at once
+# Single image for a short whose scene images all failed, from its first sentence
+FALLBACK_PROMPT = "dark cinematic scene, {}, moody atmosphere, dramatic lighting"
 
 
 def narrate_short(text: str, audio_path: str, sub_path: str,
                   voice: str = "en-US-AndrewMultilingualNeural") -> float:
     """Generate audio + subtitles for a short story. Returns duration."""
     cmd = [
-        "edge-tts",
+        EDGE_TTS,
         "--voice", voice,
         "--text", text,
         "--write-media", audio_path,
@@ -36,8 +44,17 @@ def narrate_short(text: str, audio_path: str, sub_path: str,
     ]
     try:
         subprocess.run(cmd, capture_output=True, timeout=120, check=True)
+        duration = mp3_duration(audio_path)
+        if duration is not None:
+            return duration
+        # Unreadable MP3 header: the last cue edge-tts just wrote ends where
+        # the speech does. Parsing it also warms assembly's subtitle cache.
+        from assemble_video import parse_vtt_words
+        words = parse_vtt_words(sub_path)
+        if words:
+            return words[-1][1] / 1000
         result = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-show_entries", "format=duration",
+            [FFPROBE, "-v", "quiet", "-show_entries", "format=duration",
              "-of", "csv=p=0", audio_path],
             capture_output=True, text=True, timeout=30
         )
@@ -47,8 +64,99 @@ def narrate_short(text: str, audio_path: str, sub_path: str,
         return 0
 
 
-def run_pipeline() -> dict:
-    """Run the shorts pipeline. Returns manifest dict."""
+def _scene_image(label: str, prompt: str, img_path: str, hf_token: str) -> str | None:
+    """Generate one scene image. Returns its path, or None if it failed."""
+    from fetch_visuals import generate_ai_image
+    if generate_ai_image(prompt, img_path, hf_token):
+        try:
+            size = os.stat(img_path).st_size
+        except OSError:
+            size = 0
+        if size > 5000:
+            print(f"    {label}: OK ({size/1024:.0f} KB)", file=sys.stderr)
+            return img_path
+    print(f"    {label}: failed", file=sys.stderr)
+    return None
+
+
+def _produce_short(idx: int, short: dict, hf_token: str, image_pool, assembly_pool,
+                   threads: str, work_dir: str):
+    """Narrate one short, illustrate it (images go in work_dir), and queue its assembly.
+
+    Returns (assembly_future, idx, short, output_path, duration, scene_images),
+    or None if the short was skipped.
+    """
+    from assemble_video import assemble_short
+
+    # Shorts come validated from generate_story: every field is present
+    title = short["title"] or f"Short {idx}"
+    narration = short["narration"]
+    if not narration:
+        print(f"  [SKIP] Short {idx}: no narration", file=sys.stderr)
+        return None
+
+    print(f"  [2/4] Short {idx}: narrating '{title[:50]}'...", file=sys.stderr)
+    audio_path = os.path.join(AUDIO_DIR, f"short_{idx}.mp3")
+    sub_path = os.path.join(AUDIO_DIR, f"short_{idx}.vtt")
+    duration = narrate_short(narration, audio_path, sub_path)
+
+    if duration <= 0:
+        print(f"  [SKIP] Short {idx}: narration failed", file=sys.stderr)
+        return None
+    if duration > 58:
+        print(f"  [WARN] Short {idx}: {duration:.1f}s > 58s, will be trimmed",
+              file=sys.stderr)
+    print(f"  Short {idx} duration: {duration:.1f}s", file=sys.stderr)
+
+    # Scene images go to the shared pool; fetch_visuals caps HF requests in
+    # flight and paces them across all shorts
+    scene_images = []
+    if hf_token:
+        scenes = short["scenes"]
+        print(f"  [3/4] Short {idx}: generating AI images ({len(scenes)} scenes)...",
+              file=sys.stderr)
+        futures = [
+            image_pool.submit(_scene_image, f"Short {idx} scene {j+1}", scene["visual_prompt"],
+                              os.path.join(work_dir, f"short_{idx}_scene_{j+1}.jpg"), hf_token)
+            for j, scene in enumerate(scenes)
+        ]
+        scene_images = [path for path in (f.result() for f in futures) if path]
+
+        # Fallback: if no scene images, try single image from narration
+        if not scene_images:
+            fallback_prompt = FALLBACK_PROMPT.format(narration.partition(".")[0][:80].strip())
+            fallback_path = os.path.join(work_dir, f"short_{idx}_fallback.jpg")
+            path = image_pool.submit(_scene_image, f"Short {idx} fallback", fallback_prompt,
+                                     fallback_path, hf_token).result()
+            if path:
+                scene_images.append(path)
+
+    if not scene_images:
+        print(f"  [SKIP] Short {idx}: no images generated", file=sys.stderr)
+        return None
+
+    # Step 4: Assemble with multi-image + karaoke subs, in the background
+    print(f"  [4/4] Short {idx}: assembling ({len(scene_images)} images)...", file=sys.stderr)
+    output_path = os.path.join(SHORTS_DIR, f"short_{idx}.mp4")
+    future = assembly_pool.submit(
+        assemble_short,
+        image_paths=scene_images,
+        audio_path=audio_path,
+        vtt_path=sub_path,
+        output_path=output_path,
+        hook_text=short["hook_text"],
+        duration=duration,
+        threads=threads,
+    )
+    return future, idx, short, output_path, duration, scene_images
+
+
+def run_pipeline(manifests=("tiktok", "instagram")) -> dict:
+    """Run the shorts pipeline. Returns manifest dict.
+
+    Writes a {platform}_manifest.json for each platform in `manifests`, for
+    the host's upload watchers to pick up.
+    """
     start_time = time.time()
     result = {"success": False, "error": None}
 
@@ -59,6 +167,9 @@ def run_pipeline() -> dict:
 
     hf_token = os.environ.get("HF_TOKEN", "")
 
+    from generate_story import generate_story
+    from assemble_video import ENCODE_THREADS
+
     try:
         for d in [AUDIO_DIR, VISUALS_DIR, OUTPUT_DIR, SHORTS_DIR]:
             os.makedirs(d, exist_ok=True)
@@ -73,91 +184,36 @@ def run_pipeline() -> dict:
         shorts_data = stories["shorts"]
         generated_shorts = []
 
-        for i, short in enumerate(shorts_data):
-            idx = i + 1
-            title = short.get("title", f"Short {idx}")
-            narration = short.get("narration", "")
-            scenes = short.get("scenes", [])
-            hook_text = short.get("hook_text", "")
-
-            if not narration:
-                print(f"  [SKIP] Short {idx}: no narration", file=sys.stderr)
-                continue
-
-            print(f"\n--- Short {idx}: {title[:50]} ---", file=sys.stderr)
-
-            # Step 2: Narrate
-            print(f"  [2/4] Narrating...", file=sys.stderr)
-            audio_path = os.path.join(AUDIO_DIR, f"short_{idx}.mp3")
-            sub_path = os.path.join(AUDIO_DIR, f"short_{idx}.vtt")
-            duration = narrate_short(narration, audio_path, sub_path)
-
-            if duration <= 0:
-                print(f"  [SKIP] Short {idx}: narration failed", file=sys.stderr)
-                continue
-
-            if duration > 58:
-                print(f"  [WARN] Short {idx}: {duration:.1f}s > 58s, will be trimmed",
-                      file=sys.stderr)
-
-            print(f"  Duration: {duration:.1f}s", file=sys.stderr)
-
-            # Step 3: Generate AI images for each scene
-            print(f"  [3/4] Generating AI images ({len(scenes)} scenes)...", file=sys.stderr)
-            scene_images = []
-
-            if hf_token and scenes:
-                for j, scene in enumerate(scenes):
-                    # Handle both {"visual_prompt": "..."} and plain string formats
-                    if isinstance(scene, dict):
-                        prompt = scene.get("visual_prompt", "")
-                    elif isinstance(scene, str):
-                        prompt = scene
-                    else:
-                        continue
-                    if not prompt:
-                        continue
-                    img_path = os.path.join(VISUALS_DIR, f"short_{idx}_scene_{j+1}.jpg")
-
-                    print(f"    Scene {j+1}: generating...", file=sys.stderr)
-                    if generate_ai_image(prompt, img_path, hf_token):
-                        if os.path.exists(img_path) and os.path.getsize(img_path) > 5000:
-                            scene_images.append(img_path)
-                            print(f"    Scene {j+1}: OK ({os.path.getsize(img_path)/1024:.0f} KB)",
-                                  file=sys.stderr)
-                    else:
-                        print(f"    Scene {j+1}: failed", file=sys.stderr)
-
-                    time.sleep(2)  # HuggingFace rate limit
-
-            # Fallback: if no scene images, try single image from narration
-            if not scene_images and hf_token:
-                fallback_prompt = f"dark cinematic scene, {narration.split('.')[0][:80]}, moody atmosphere, dramatic lighting"
-                fallback_path = os.path.join(VISUALS_DIR, f"short_{idx}_fallback.jpg")
-                print(f"    Fallback: generating from narration...", file=sys.stderr)
-                if generate_ai_image(fallback_prompt, fallback_path, hf_token):
-                    if os.path.exists(fallback_path) and os.path.getsize(fallback_path) > 5000:
-                        scene_images.append(fallback_path)
-                time.sleep(2)
-
-            if not scene_images:
-                print(f"  [SKIP] Short {idx}: no images generated", file=sys.stderr)
+        # Assemblies are single-threaded ffmpeg encodes: one per core. A lone
+        # assembly gets the whole machine instead.
+        assembly_workers = max(1, min(os.cpu_count() or 1, len(shorts_data)))
+        threads = "1" if assembly_workers > 1 else ENCODE_THREADS
+
+        # Steps 2-4 run as a pipeline: each short has its own driver thread, so
+        # one short's images are generated while the next is narrated and the
+        # previous one is encoding. TTS, HF and ffmpeg never wait on each other.
+        # Scene images live in a per-run directory, removed once every assembly
+        # has finished (or the run fails part way).
+        with tempfile.TemporaryDirectory(dir=VISUALS_DIR, prefix="run_") as work_dir:
+            with ThreadPoolExecutor(max_workers=max(1, IMAGE_JOBS)) as image_pool, \
+                    ThreadPoolExecutor(max_workers=assembly_workers) as assembly_pool, \
+                    ThreadPoolExecutor(max_workers=len(shorts_data)) as driver_pool:
+                drivers = [
+                    driver_pool.submit(_produce_short, i + 1, short, hf_token,
+                                       image_pool, assembly_pool, threads, work_dir)
+                    for i, short in enumerate(shorts_data)
+                ]
+                pending = [driver.result() for driver in drivers]
+
+        for job in pending:
+            if job is None:
                 continue
-
-            print(f"  Images: {len(scene_images)} generated", file=sys.stderr)
-
-            # Step 4: Assemble short with multi-image + karaoke subs
-            print(f"  [4/4] Assembling short ({len(scene_images)} images)...", file=sys.stderr)
-            output_path = os.path.join(SHORTS_DIR, f"short_{idx}.mp4")
-
-            success = assemble_short(
-                image_paths=scene_images,
-                audio_path=audio_path,
-                vtt_path=sub_path,
-                output_path=output_path,
-                hook_text=hook_text,
-                duration=duration,
-            )
+            future, idx, short, output_path, duration, scene_images = job
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"  [ERR] Short {idx}: {e}", file=sys.stderr)
+                success = False
 
             if success:
                 size_mb = os.path.getsize(output_path) / (1024 * 1024)
@@ -165,24 +221,17 @@ def run_pipeline() -> dict:
                       file=sys.stderr)
                 generated_shorts.append({
                     "path": output_path,
-                    "title": title,
-                    "description": short.get("description", ""),
-                    "tags": short.get("tags", []),
+                    "title": short["title"] or f"Short {idx}",
+                    "description": short["description"],
+                    "tags": short["tags"],
                     "duration": round(duration, 1),
-                    "hook_text": hook_text,
+                    "hook_text": short["hook_text"],
                     "images_used": len(scene_images),
-                    "source_subreddit": short.get("source_subreddit", ""),
+                    "source_subreddit": short["source_subreddit"],
                 })
             else:
                 print(f"  [FAIL] Short {idx}: assembly failed", file=sys.stderr)
 
-            # Cleanup scene images
-            for img in scene_images:
-                try:
-                    os.remove(img)
-                except OSError:
-                    pass
-
         elapsed = time.time() - start_time
 
         if not generated_shorts:
@@ -206,11 +255,11 @@ def run_pipeline() -> dict:
         }
 
         # Save manifests for platform uploads (run on host via cron)
-        for platform in ["tiktok", "instagram"]:
+        for platform in manifests:
             manifest_path = os.path.join(OUTPUT_DIR, f"{platform}_manifest.json")
             try:
                 with open(manifest_path, "w") as mf:
-                    json.dump(result, mf, indent=2)
+                    mf.write(json.dumps(result, indent=2))
                 print(f"  {platform.capitalize()} manifest saved: {manifest_path}", file=sys.stderr)
             except Exception as e:
                 print(f"  [WARN] Could not save {platform} manifest: {e}", file=sys.stderr)
@@ -228,7 +277,31 @@ def main():
     print("  SHORTS PIPELINE - Reddit Stories Edition", file=sys.stderr)
     print("=" * 50, file=sys.stderr)
 
-    result = run_pipeline()
+    # --upload-instagram publishes the Reels from this process instead of
+    # leaving a manifest for instagram_watcher.sh (which would upload them again)
+    upload_instagram = "--upload-instagram" in sys.argv[1:]
+    result = run_pipeline(manifests=("tiktok",) if upload_instagram else ("tiktok", "instagram"))
+
+    if upload_instagram and result.get("success"):
+        from upload_instagram import upload_from_dict
+        print("\n[Instagram] Uploading Reels...", file=sys.stderr)
+        try:
+            result["instagram_upload"] = upload_from_dict(result)
+        except SystemExit:  # get_access_token exits when there are no tokens
+            result["instagram_upload"] = {"success": False, "error": "No Instagram tokens"}
+        except Exception as e:
+            result["instagram_upload"] = {"success": False, "error": str(e)}
+
+        # Nothing went up: leave the manifest so instagram_watcher.sh retries
+        if not result["instagram_upload"].get("success"):
+            manifest = {k: v for k, v in result.items() if k != "instagram_upload"}
+            manifest_path = os.path.join(OUTPUT_DIR, "instagram_manifest.json")
+            try:
+                with open(manifest_path, "w") as mf:
+                    mf.write(json.dumps(manifest, indent=2))
+                print(f"  Instagram upload failed, manifest saved: {manifest_path}", file=sys.stderr)
+            except Exception as e:
+                print(f"  [WARN] Could not save instagram manifest: {e}", file=sys.stderr)
 
     # Output result as JSON (for n8n to parse)
     print(json.dumps(result, indent=2))
@@ -4,23 +4,28 @@ Instagram Reels Upload via Instagram Graph API.
 Uses Instagram Login (IGAA tokens) + Content Publishing API.
 
 Flow:
-  1. Upload video via public URL -> create media container
+  1. Create a resumable media container and upload the video bytes to it
+     (rupload.facebook.com), or create the container from a public URL
   2. Wait for container to finish processing
   3. Publish the container
 
 Requires:
   - Instagram Professional account (Creator or Business)
   - Facebook App with instagram_content_publish permission
-  - Video accessible via public URL (served by nginx on this server)
+  - The video on local disk, or accessible via public URL (served by nginx)
 """
 
 import json
 import os
 import sys
+import threading
 import time
 import urllib.request
 import urllib.parse
 import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+from http_utils import open_url
 
 # ─── Configuration ──────────────────────────────────────────────────
 INSTAGRAM_APP_ID = os.environ.get("INSTAGRAM_APP_ID", "")
@@ -32,6 +37,17 @@ INSTAGRAM_VIDEO_BASE_URL = os.environ.get("INSTAGRAM_VIDEO_BASE_URL", "https://j
 IG_GRAPH_API = "https://graph.instagram.com"
 IG_GRAPH_API_V = "https://graph.instagram.com/v21.0"
 
+CORE_TAGS = ("fyp", "viral", "storytime", "shorts", "reddit", "reels")  # added to every caption
+CAPTION_MAX = 2200  # Instagram's caption limit
+
+POLL_TIMEOUT = 180  # seconds to wait for a container to finish processing
+GET_RETRIES = 3  # retries for reads (status polls, token lookups) on 5xx
+RETRY_STATUSES = {500, 502, 503, 504}
+UPLOAD_JOBS = int(os.environ.get("INSTAGRAM_UPLOAD_JOBS", "4"))  # manifest shorts in flight at once
+
+# Containers upload and process in parallel, but publish one at a time
+_publish_lock = threading.Lock()
+
 TOKEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instagram_tokens.json")
 
 
@@ -50,10 +66,11 @@ def save_tokens(token_data):
 
 
 def load_tokens():
-    if not os.path.exists(TOKEN_FILE):
+    try:
+        with open(TOKEN_FILE, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
         return None
-    with open(TOKEN_FILE, "r") as f:
-        data = json.load(f)
     if time.time() > data.get("expires_at", 0):
         print("  [tokens] Token expired. Refresh needed.", file=sys.stderr)
         return None
@@ -77,18 +94,25 @@ def _api_get(url, params=None):
     if params:
         url = f"{url}?{urllib.parse.urlencode(params)}"
     req = urllib.request.Request(url, method="GET")
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        return json.loads(resp.read().decode("utf-8"))
+    # GETs are safe to repeat, so ride out brief Graph API 5xx blips
+    for attempt in range(GET_RETRIES + 1):
+        try:
+            with open_url(req, timeout=30) as resp:
+                return json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            if e.code not in RETRY_STATUSES or attempt == GET_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
 
 
-def _api_post(url, params):
+def _api_post(url, params, fresh=False):
     body = urllib.parse.urlencode(params).encode("utf-8")
     req = urllib.request.Request(url, data=body, headers={
         "Content-Type": "application/x-www-form-urlencoded",
     }, method="POST")
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            return json.loads(resp.read().decode("utf-8"))
+        with open_url(req, timeout=60, fresh=fresh) as resp:
+            return json.loads(resp.read())
     except urllib.error.HTTPError as e:
         err = e.read().decode("utf-8")
         print(f"  [API] HTTP {e.code}: {err}", file=sys.stderr)
@@ -181,7 +205,7 @@ def run_auth_flow(token_arg=None):
 # ─── Instagram Publishing API ────────────────────────────────────────
 
 def create_reel_container(user_id, access_token, video_url, caption):
-    """Step 1: Create a media container for the Reel."""
+    """Step 1: Create a media container for the Reel from a public URL."""
     params = {
         "media_type": "REELS",
         "video_url": video_url,
@@ -198,6 +222,52 @@ def create_reel_container(user_id, access_token, video_url, caption):
     return container_id
 
 
+def create_resumable_container(user_id, access_token, caption):
+    """Step 1: Create a media container that takes the video bytes directly.
+
+    Returns (container_id, upload_uri).
+    """
+    result = _api_post(f"{IG_GRAPH_API_V}/{user_id}/media", {
+        "media_type": "REELS",
+        "upload_type": "resumable",
+        "caption": caption,
+        "access_token": access_token,
+    })
+
+    container_id = result.get("id")
+    upload_uri = result.get("uri")
+    if not container_id or not upload_uri:
+        raise RuntimeError(f"Failed to create container: {result}")
+
+    print(f"  [container] Created: {container_id}", file=sys.stderr)
+    return container_id, upload_uri
+
+
+def upload_video_file(upload_uri, access_token, video_path):
+    """Send the video to a resumable container, streamed from disk."""
+    file_size = os.path.getsize(video_path)
+    print(f"  [upload] Sending {file_size / 1024 / 1024:.1f} MB...", file=sys.stderr)
+
+    with open(video_path, "rb") as f:
+        req = urllib.request.Request(upload_uri, data=f, headers={
+            "Authorization": f"OAuth {access_token}",
+            "offset": "0",
+            "file_size": str(file_size),
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(file_size),
+        }, method="POST")
+        try:
+            with urllib.request.urlopen(req, timeout=300) as resp:
+                result = json.loads(resp.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            err = e.read().decode("utf-8")
+            print(f"  [API] HTTP {e.code}: {err}", file=sys.stderr)
+            raise RuntimeError(f"Upload error {e.code}: {err}")
+
+    if not result.get("success"):
+        raise RuntimeError(f"Upload failed: {result}")
+
+
 def check_container_status(container_id, access_token):
     """Check if the media container is ready for publishing."""
     result = _api_get(f"{IG_GRAPH_API_V}/{container_id}", {
@@ -207,12 +277,95 @@ def check_container_status(container_id, access_token):
     return result.get("status_code", "UNKNOWN"), result.get("status", "")
 
 
+def check_container_statuses(container_ids, access_token):
+    """Status of several containers in one request: {container_id: (status_code, status)}."""
+    if len(container_ids) == 1:
+        return {container_ids[0]: check_container_status(container_ids[0], access_token)}
+    result = _api_get(f"{IG_GRAPH_API_V}/", {
+        "ids": ",".join(container_ids),
+        "fields": "status_code,status",
+        "access_token": access_token,
+    })
+    return {cid: (info.get("status_code", "UNKNOWN"), info.get("status", ""))
+            for cid, info in result.items()}
+
+
+class _StatusPoller:
+    """One thread polling every in-flight container, with a single batched request.
+
+    Polls start 1s apart and back off to 10s; a newly added container resets
+    the delay, since a freshly uploaded Reel is usually ready within seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = {}  # container_id -> {"event", "status"}
+        self._token = None
+        self._delay = 1.0
+        self._thread = None
+
+    def wait(self, container_id, access_token, timeout):
+        """Block until the container is FINISHED or ERROR: (status_code, status)."""
+        entry = {"event": threading.Event(), "status": ("TIMEOUT", "")}
+        with self._lock:
+            self._waiting[container_id] = entry
+            self._token = access_token
+            self._delay = 1.0
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        if not entry["event"].wait(timeout):
+            with self._lock:
+                self._waiting.pop(container_id, None)
+        return entry["status"]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._waiting:
+                    self._thread = None
+                    return
+                delay = self._delay
+                self._delay = min(delay * 1.5, 10)
+            time.sleep(delay)
+
+            with self._lock:
+                ids, token = list(self._waiting), self._token
+            if not ids:
+                continue
+            try:
+                statuses = check_container_statuses(ids, token)
+            except Exception as e:
+                # Batched lookups failing shouldn't strand anyone; ask one by one
+                print(f"  [status] Batched check failed ({e}), polling individually",
+                      file=sys.stderr)
+                statuses = {}
+                for cid in ids:
+                    try:
+                        statuses[cid] = check_container_status(cid, token)
+                    except Exception as e:
+                        print(f"  [status] {cid}: check failed: {e}", file=sys.stderr)
+
+            with self._lock:
+                for cid, (status_code, status_msg) in statuses.items():
+                    print(f"  [status] {cid}: {status_code} {status_msg}", file=sys.stderr)
+                    if status_code in ("FINISHED", "ERROR") and cid in self._waiting:
+                        entry = self._waiting.pop(cid)
+                        entry["status"] = (status_code, status_msg)
+                        entry["event"].set()
+
+
+_status_poller = _StatusPoller()
+
+
 def publish_container(user_id, access_token, container_id):
     """Step 2: Publish the media container."""
+    # A replayed publish posts the Reel twice, and this thread's connection
+    # has sat idle through the upload and processing wait: use a new one
     result = _api_post(f"{IG_GRAPH_API_V}/{user_id}/media_publish", {
         "creation_id": container_id,
         "access_token": access_token,
-    })
+    }, fresh=True)
 
     media_id = result.get("id")
     if not media_id:
@@ -222,34 +375,33 @@ def publish_container(user_id, access_token, container_id):
     return media_id
 
 
-def upload_reel(video_url, caption, access_token=None, user_id=None):
-    """Upload a single Reel. Returns result dict."""
+def upload_reel(video, caption, access_token=None, user_id=None):
+    """Upload a single Reel from a local file or a public URL. Returns result dict."""
     if not access_token or not user_id:
         access_token, user_id = get_access_token()
 
-    print(f"  [upload] Video URL: {video_url}", file=sys.stderr)
+    print(f"  [upload] Video: {video}", file=sys.stderr)
     print(f"  [upload] Caption: {caption[:80]}...", file=sys.stderr)
 
-    # Step 1: Create container
-    container_id = create_reel_container(user_id, access_token, video_url, caption)
+    # Step 1: Create container (uploading the file ourselves when we have it)
+    if video.startswith(("http://", "https://")):
+        container_id = create_reel_container(user_id, access_token, video, caption)
+    else:
+        container_id, upload_uri = create_resumable_container(user_id, access_token, caption)
+        upload_video_file(upload_uri, access_token, video)
 
-    # Step 2: Wait for processing (Reels can take a while)
+    # Step 2: Wait for processing, polled together with any other uploads in flight
     print(f"  [status] Waiting for processing...", file=sys.stderr)
-    for attempt in range(36):  # max 3 min
-        time.sleep(5)
-        status_code, status_msg = check_container_status(container_id, access_token)
-        print(f"  [status] {status_code} {status_msg}", file=sys.stderr)
-
-        if status_code == "FINISHED":
-            break
-        if status_code == "ERROR":
-            return {"success": False, "status": status_code,
-                    "error": status_msg, "container_id": container_id}
-    else:
+    status_code, status_msg = _status_poller.wait(container_id, access_token, POLL_TIMEOUT)
+    if status_code == "TIMEOUT":
         return {"success": False, "status": "TIMEOUT", "container_id": container_id}
+    if status_code == "ERROR":
+        return {"success": False, "status": status_code,
+                "error": status_msg, "container_id": container_id}
 
     # Step 3: Publish
-    media_id = publish_container(user_id, access_token, container_id)
+    with _publish_lock:
+        media_id = publish_container(user_id, access_token, container_id)
 
     return {
         "success": True,
@@ -259,31 +411,41 @@ def upload_reel(video_url, caption, access_token=None, user_id=None):
     }
 
 
-def upload_short(video_path, title, tags=None):
-    """Upload a single short as a Reel. Builds public URL from file path."""
-    access_token, user_id = get_access_token()
+def build_caption(title, tags=None):
+    """Title plus hashtags (the short's own, then CORE_TAGS), each tag once."""
+    names = dict.fromkeys(t.lstrip("#") for t in [*(tags or []), *CORE_TAGS])
+    caption = f"{title} " + " ".join(f"#{t}" for t in names if t)
+    return caption[:CAPTION_MAX]
+
 
-    # Build public URL from local path
-    filename = os.path.basename(video_path)
-    video_url = f"{INSTAGRAM_VIDEO_BASE_URL}/{filename}"
+def _video_source(video_path):
+    """The local file to upload, or its public URL when it isn't on this host."""
+    # Manifest paths come from Docker, where /pipeline maps to /home/ubuntu/pipeline
+    if video_path.startswith("/pipeline/"):
+        host_path = "/home/ubuntu/pipeline/" + video_path[len("/pipeline/"):]
+        if os.path.isfile(host_path):
+            return host_path
+    if os.path.isfile(video_path):
+        return video_path
+    return f"{INSTAGRAM_VIDEO_BASE_URL}/{os.path.basename(video_path)}"
 
-    # Build caption with hashtags
-    tag_str = ""
-    if tags:
-        tag_str = " " + " ".join(f"#{t.lstrip('#')}" for t in tags)
-    core_tags = "#fyp #viral #storytime #shorts #reddit #reels"
-    caption = f"{title}{tag_str} {core_tags}"
-    if len(caption) > 2200:
-        caption = caption[:2200]
 
-    return upload_reel(video_url, caption, access_token, user_id)
+def upload_short(video_path, title, tags=None):
+    """Upload a single short as a Reel, from disk when the file is local."""
+    access_token, user_id = get_access_token()
+    video = _video_source(video_path)
+    return upload_reel(video, build_caption(title, tags), access_token, user_id)
 
 
 def upload_from_manifest(manifest_path, max_uploads=None):
-    """Upload shorts from pipeline manifest. Optionally limit to max_uploads."""
+    """Upload shorts from a pipeline manifest file. Optionally limit to max_uploads."""
     with open(manifest_path) as f:
         manifest = json.load(f)
+    return upload_from_dict(manifest, max_uploads)
 
+
+def upload_from_dict(manifest, max_uploads=None):
+    """Upload shorts from a pipeline result dict (what the manifest file holds)."""
     if not manifest.get("success"):
         return {"success": False, "error": "Pipeline manifest shows failure"}
 
@@ -297,38 +459,25 @@ def upload_from_manifest(manifest_path, max_uploads=None):
 
     access_token, user_id = get_access_token()
 
-    results = []
-    for i, short in enumerate(shorts):
-        path = short.get("path", "")
-        title = short.get("title", f"Short {i+1}")
-        tags = short.get("tags", [])
-
-        # Build public URL
-        filename = os.path.basename(path)
-        video_url = f"{INSTAGRAM_VIDEO_BASE_URL}/{filename}"
-
-        # Build caption
-        tag_str = ""
-        if tags:
-            tag_str = " " + " ".join(f"#{t.lstrip('#')}" for t in tags)
-        core_tags = "#fyp #viral #storytime #shorts #reddit #reels"
-        caption = f"{title}{tag_str} {core_tags}"
-        if len(caption) > 2200:
-            caption = caption[:2200]
+    titles = [short.get("title", f"Short {i+1}") for i, short in enumerate(shorts)]
+    captions = [build_caption(title, short.get("tags", [])) for title, short in zip(titles, shorts)]
+
+    def upload_one(i, short):
+        title, caption = titles[i], captions[i]
+        video = _video_source(short.get("path", ""))
 
         print(f"\n--- Instagram Upload {i+1}/{len(shorts)}: {title} ---", file=sys.stderr)
 
         try:
-            result = upload_reel(video_url, caption, access_token, user_id)
+            result = upload_reel(video, caption, access_token, user_id)
         except Exception as e:
             result = {"success": False, "error": str(e)}
 
         result["title"] = title
-        results.append(result)
+        return result
 
-        if i < len(shorts) - 1:
-            print("  Waiting 30s (IG rate limit)...", file=sys.stderr)
-            time.sleep(30)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(shorts), UPLOAD_JOBS))) as pool:
+        results = list(pool.map(upload_one, range(len(shorts)), shorts))
 
     uploaded = sum(1 for r in results if r.get("success"))
     return {"success": uploaded > 0, "uploaded": uploaded, "total": len(shorts),
@@ -4,6 +4,7 @@ TikTok Content Posting API - Direct Post Video Upload.
 Uses official API (no browser automation needed).
 """
 
+import http.client
 import json
 import os
 import sys
@@ -14,6 +15,9 @@ import urllib.error
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import secrets
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from http_utils import TokenBucket, open_url
 
 # ─── Configuration ──────────────────────────────────────────────────
 CLIENT_KEY = os.environ.get("TIKTOK_CLIENT_KEY", "")
@@ -23,9 +27,30 @@ REDIRECT_URI = os.environ.get("TIKTOK_REDIRECT_URI", "https://avarajar.github.io
 BASE_URL = "https://open.tiktokapis.com"
 AUTH_URL = "https://www.tiktok.com/v2/auth/authorize/"
 TOKEN_URL = f"{BASE_URL}/v2/oauth/token/"
+CREATOR_URL = f"{BASE_URL}/v2/post/publish/creator_info/query/"
+INIT_URL = f"{BASE_URL}/v2/post/publish/video/init/"
+STATUS_URL = f"{BASE_URL}/v2/post/publish/status/fetch/"
 
 TOKEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktok_tokens.json")
 
+# Files of at least CHUNKED_MIN go up in CHUNK_SIZE pieces (TikTok allows
+# 5-64 MB; the last chunk absorbs the remainder). Anything smaller would be a
+# single chunk anyway, so it goes up whole. TikTok documents chunks arriving in
+# order, so they're sent one at a time unless TIKTOK_PARALLEL_CHUNKS says otherwise.
+CHUNK_SIZE = 10 * 1024 * 1024
+CHUNKED_MIN = 2 * CHUNK_SIZE
+PARALLEL_CHUNKS = int(os.environ.get("TIKTOK_PARALLEL_CHUNKS", "1"))
+CHUNK_RETRIES = 2
+
+CORE_TAGS = ("fyp", "viral", "storytime", "shorts", "reddit")  # added to every description
+DESCRIPTION_MAX = 2200  # TikTok's title/description limit
+
+STATUS_TIMEOUT = 120  # seconds to wait for TikTok to finish publishing
+UPLOAD_JOBS = int(os.environ.get("TIKTOK_UPLOAD_JOBS", "2"))  # manifest shorts in flight at once
+
+# Video inits are rate limited per user: allow a couple at once, then one per 10s
+_init_bucket = TokenBucket(rate=0.1, capacity=2)
+
 
 # ─── Token Management ───────────────────────────────────────────────
 
@@ -43,11 +68,20 @@ def save_tokens(token_data):
     return to_save
 
 
+_token_cache = {"key": None, "data": None}  # last parse of TOKEN_FILE, by mtime + size
+
+
 def load_tokens():
-    if not os.path.exists(TOKEN_FILE):
+    try:
+        with open(TOKEN_FILE, "rb") as f:
+            st = os.fstat(f.fileno())
+            key = (st.st_mtime_ns, st.st_size)
+            if key != _token_cache["key"]:
+                _token_cache["data"] = json.loads(f.read())
+                _token_cache["key"] = key
+    except FileNotFoundError:
         return None
-    with open(TOKEN_FILE, "r") as f:
-        data = json.load(f)
+    data = dict(_token_cache["data"])
     if time.time() > data.get("refresh_expires_at", 0):
         print("  [tokens] Refresh token expired. Re-auth needed.", file=sys.stderr)
         return None
@@ -59,8 +93,8 @@ def _post_form(url, params):
     req = urllib.request.Request(url, data=body, headers={
         "Content-Type": "application/x-www-form-urlencoded",
     }, method="POST")
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        return json.loads(resp.read().decode("utf-8"))
+    with open_url(req, timeout=30) as resp:
+        return json.loads(resp.read())
 
 
 def exchange_code(auth_code):
@@ -134,14 +168,20 @@ def run_auth_flow():
     })
     auth_url = f"{AUTH_URL}?{auth_params}"
 
-    print("\n" + "=" * 60, file=sys.stderr)
-    print("  TIKTOK AUTHORIZATION", file=sys.stderr)
-    print("=" * 60, file=sys.stderr)
-    print(f"\n  Open this link in your browser:\n", file=sys.stderr)
-    print(f"  {auth_url}\n", file=sys.stderr)
-    print("  After authorizing, you will be redirected.", file=sys.stderr)
-    print("  Copy the FULL URL from your browser's address bar", file=sys.stderr)
-    print("  and paste it below.\n", file=sys.stderr)
+    rule = "=" * 60
+    print(f"""
+{rule}
+  TIKTOK AUTHORIZATION
+{rule}
+
+  Open this link in your browser:
+
+  {auth_url}
+
+  After authorizing, you will be redirected.
+  Copy the FULL URL from your browser's address bar
+  and paste it below.
+""", file=sys.stderr)
 
     redirected_url = input("  Paste redirected URL here: ").strip()
 
@@ -160,17 +200,16 @@ def run_auth_flow():
 
 # ─── TikTok API ──────────────────────────────────────────────────────
 
-def _api(method, path, access_token, body=None, _retried=False):
-    url = f"{BASE_URL}{path}"
+def _api(method, url, access_token, body=None, fresh=False, _retried=False):
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json; charset=UTF-8",
     }
-    data = json.dumps(body).encode("utf-8") if body else None
+    data = json.dumps(body, separators=(",", ":")).encode("utf-8") if body else None
     req = urllib.request.Request(url, data=data, headers=headers, method=method)
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            return json.loads(resp.read().decode("utf-8"))
+        with open_url(req, timeout=30, fresh=fresh) as resp:
+            return json.loads(resp.read())
     except urllib.error.HTTPError as e:
         err = e.read().decode("utf-8")
         print(f"  [API] HTTP {e.code}: {err}", file=sys.stderr)
@@ -180,29 +219,104 @@ def _api(method, path, access_token, body=None, _retried=False):
             tokens = load_tokens()
             if tokens and tokens.get("refresh_token"):
                 new_tokens = refresh_token(tokens["refresh_token"])
-                return _api(method, path, new_tokens["access_token"], body, _retried=True)
+                return _api(method, url, new_tokens["access_token"], body, fresh, _retried=True)
         raise RuntimeError(f"API error {e.code}: {err}")
 
 
+_creator_cache = {}  # access_token -> creator info; stable while the token is
+
+
 def query_creator(access_token):
-    result = _api("POST", "/v2/post/publish/creator_info/query/", access_token)
+    if access_token in _creator_cache:
+        return _creator_cache[access_token]
+    result = _api("POST", CREATOR_URL, access_token)
     if result.get("error", {}).get("code") != "ok":
         raise RuntimeError(f"Creator info failed: {result}")
     data = result["data"]
     print(f"  [creator] @{data['creator_username']} ({data['creator_nickname']})", file=sys.stderr)
     print(f"  [creator] Privacy: {data['privacy_level_options']}", file=sys.stderr)
+    _creator_cache[access_token] = data
     return data
 
 
+def _prefetch(video_path):
+    """Ask the kernel to start reading the file into page cache (Linux only).
+
+    WILLNEED readahead is asynchronous, so the disk read overlaps the init
+    round-trip and the PUT then streams from memory.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(video_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _put_chunk(upload_url, video_path, start, end, file_size):
+    """PUT bytes start..end (inclusive) of the video, retrying a failed chunk.
+
+    The body goes out with socket.sendfile(): the kernel copies straight from
+    page cache on plain HTTP, and Python falls back to a send loop over TLS,
+    so the chunk is never held in memory either way.
+    """
+    parts = urllib.parse.urlsplit(upload_url)
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path or "/"
+    conn_cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    length = end - start + 1
+
+    for attempt in range(CHUNK_RETRIES + 1):
+        conn = conn_cls(parts.netloc, timeout=120)
+        try:
+            conn.putrequest("PUT", path)
+            conn.putheader("Content-Type", "video/mp4")
+            conn.putheader("Content-Length", str(length))
+            conn.putheader("Content-Range", f"bytes {start}-{end}/{file_size}")
+            conn.endheaders()
+            with open(video_path, "rb") as f:
+                conn.sock.sendfile(f, offset=start, count=length)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(upload_url, resp.status, resp.reason, resp.headers, None)
+            print(f"  [upload] bytes {start}-{end} -> HTTP {resp.status}", file=sys.stderr)
+            return
+        except (http.client.HTTPException, OSError) as e:
+            if attempt == CHUNK_RETRIES or getattr(e, "code", 500) < 500:
+                raise
+            print(f"  [upload] bytes {start}-{end} failed ({e}), retrying...", file=sys.stderr)
+            time.sleep(2 ** attempt)
+        finally:
+            conn.close()
+
+
+def chunk_ranges(file_size):
+    """(chunk_size, [(start, end), ...]) for uploading file_size bytes.
+
+    Ranges are inclusive byte offsets; the last one runs to the end of the
+    file, so it can be up to twice CHUNK_SIZE.
+    """
+    if file_size < CHUNKED_MIN:
+        return file_size, [(0, file_size - 1)]
+    total_chunks = max(1, file_size // CHUNK_SIZE)
+    ranges = [(i * CHUNK_SIZE, file_size - 1 if i == total_chunks - 1 else (i + 1) * CHUNK_SIZE - 1)
+              for i in range(total_chunks)]
+    return CHUNK_SIZE, ranges
+
+
 def upload_video(video_path, title, access_token, privacy="SELF_ONLY"):
     """Complete upload flow: init -> upload file -> check status."""
     file_size = os.path.getsize(video_path)
-
-    # Single chunk for shorts (< 64MB)
-    chunk_size = file_size
-    total_chunks = 1
+    chunk_size, ranges = chunk_ranges(file_size)
+    total_chunks = len(ranges)
 
     print(f"  [upload] File: {video_path} ({file_size / 1024 / 1024:.1f} MB)", file=sys.stderr)
+    _prefetch(video_path)
 
     # Init
     body = {
@@ -222,7 +336,10 @@ def upload_video(video_path, title, access_token, privacy="SELF_ONLY"):
         },
     }
 
-    result = _api("POST", "/v2/post/publish/video/init/", access_token, body)
+    _init_bucket.acquire()
+    # Every init that reaches TikTok starts its own publish, so it goes out on
+    # a new connection and is never resent on a stale one
+    result = _api("POST", INIT_URL, access_token, body, fresh=True)
     if result.get("error", {}).get("code") != "ok":
         raise RuntimeError(f"Init failed: {result}")
 
@@ -230,24 +347,23 @@ def upload_video(video_path, title, access_token, privacy="SELF_ONLY"):
     upload_url = result["data"]["upload_url"]
     print(f"  [upload] publish_id: {publish_id}", file=sys.stderr)
 
-    # Upload file
-    with open(video_path, "rb") as f:
-        video_data = f.read()
-
-    req = urllib.request.Request(upload_url, data=video_data, headers={
-        "Content-Type": "video/mp4",
-        "Content-Length": str(file_size),
-        "Content-Range": f"bytes 0-{file_size - 1}/{file_size}",
-    }, method="PUT")
-
-    with urllib.request.urlopen(req, timeout=120) as resp:
-        print(f"  [upload] Uploaded -> HTTP {resp.status}", file=sys.stderr)
+    # Upload file, streamed from disk rather than read into memory
+    if total_chunks > 1 and PARALLEL_CHUNKS > 1:
+        with ThreadPoolExecutor(max_workers=min(PARALLEL_CHUNKS, total_chunks)) as pool:
+            list(pool.map(lambda r: _put_chunk(upload_url, video_path, r[0], r[1], file_size), ranges))
+    else:
+        for start, end in ranges:
+            _put_chunk(upload_url, video_path, start, end, file_size)
 
-    # Poll status
+    # Poll status: short clips usually publish within seconds, so start
+    # quickly and back off for the slow ones
     print(f"  [status] Checking publish status...", file=sys.stderr)
-    for _ in range(24):  # max 2 min
-        time.sleep(5)
-        status_result = _api("POST", "/v2/post/publish/status/fetch/", access_token,
+    delay = 1.0
+    deadline = time.monotonic() + STATUS_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 1.6, 10)
+        status_result = _api("POST", STATUS_URL, access_token,
                              {"publish_id": publish_id})
         if status_result.get("error", {}).get("code") != "ok":
             continue
@@ -266,9 +382,17 @@ def upload_video(video_path, title, access_token, privacy="SELF_ONLY"):
     return {"success": False, "status": "TIMEOUT", "publish_id": publish_id}
 
 
-def upload_short(video_path, title, tags=None):
+def build_description(title, tags=None):
+    """Title plus hashtags (the short's own, then CORE_TAGS), each tag once."""
+    names = dict.fromkeys(t.lstrip("#") for t in [*(tags or []), *CORE_TAGS])
+    description = f"{title} " + " ".join(f"#{t}" for t in names if t)
+    return description[:DESCRIPTION_MAX]
+
+
+def upload_short(video_path, title, tags=None, access_token=None):
     """Upload a single short with title and tags."""
-    access_token = get_access_token()
+    if not access_token:
+        access_token = get_access_token()
 
     # Query creator to get available privacy levels
     creator = query_creator(access_token)
@@ -277,14 +401,7 @@ def upload_short(video_path, title, tags=None):
     # Default to SELF_ONLY while app is under review; change manually once approved
     privacy = "SELF_ONLY"
 
-    # Build description with hashtags
-    tag_str = ""
-    if tags:
-        tag_str = " " + " ".join(f"#{t.lstrip('#')}" for t in tags)
-    core_tags = "#fyp #viral #storytime #shorts #reddit"
-    description = f"{title}{tag_str} {core_tags}"
-    if len(description) > 2200:
-        description = description[:2200]
+    description = build_description(title, tags)
 
     print(f"  [post] Privacy: {privacy}", file=sys.stderr)
     print(f"  [post] Title: {description[:80]}...", file=sys.stderr)
@@ -294,8 +411,8 @@ def upload_short(video_path, title, tags=None):
 
 def upload_from_manifest(manifest_path, max_uploads=None):
     """Upload shorts from pipeline manifest. Optionally limit to max_uploads."""
-    with open(manifest_path) as f:
-        manifest = json.load(f)
+    with open(manifest_path, "rb") as f:
+        manifest = json.loads(f.read())
 
     if not manifest.get("success"):
         return {"success": False, "error": "Pipeline manifest shows failure"}
@@ -308,8 +425,10 @@ def upload_from_manifest(manifest_path, max_uploads=None):
         print(f"  [limit] Uploading {max_uploads} of {len(shorts)} shorts", file=sys.stderr)
         shorts = shorts[:max_uploads]
 
-    results = []
-    for i, short in enumerate(shorts):
+    # One token for the batch; get_access_token refreshes it ahead of expiry
+    access_token = get_access_token()
+
+    def upload_one(i, short):
         path = short.get("path", "")
         # Translate Docker container path to host path
         # assemble_video.py runs inside Docker where /pipeline maps to /home/ubuntu/pipeline on host
@@ -319,13 +438,15 @@ def upload_from_manifest(manifest_path, max_uploads=None):
         tags = short.get("tags", [])
 
         print(f"\n--- TikTok Upload {i+1}/{len(shorts)}: {title} ---", file=sys.stderr)
-        result = upload_short(path, title, tags)
+        try:
+            result = upload_short(path, title, tags, access_token)
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
         result["title"] = title
-        results.append(result)
+        return result
 
-        if i < len(shorts) - 1:
-            print("  Waiting 10s...", file=sys.stderr)
-            time.sleep(10)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(shorts), UPLOAD_JOBS))) as pool:
+        results = list(pool.map(upload_one, range(len(shorts)), shorts))
 
     uploaded = sum(1 for r in results if r.get("success"))
     return {"success": uploaded > 0, "uploaded": uploaded, "total": len(shorts),
@@ -337,12 +458,20 @@ if __name__ == "__main__":
         print("Set TIKTOK_CLIENT_KEY and TIKTOK_CLIENT_SECRET env vars", file=sys.stderr)
         sys.exit(1)
 
+    # Results go out as one compact JSON line (the watcher logs and parses
+    # it); --pretty indents them for reading by hand
+    indent = None
+    if "--pretty" in sys.argv:
+        sys.argv.remove("--pretty")
+        indent = 2
+
     if len(sys.argv) < 2:
-        print("Usage:", file=sys.stderr)
-        print("  upload_tiktok.py --auth              # Authorize (first time)", file=sys.stderr)
-        print("  upload_tiktok.py --refresh            # Refresh token", file=sys.stderr)
-        print("  upload_tiktok.py <video.mp4> [title]  # Upload video", file=sys.stderr)
-        print("  upload_tiktok.py --manifest <file>    # Upload from manifest", file=sys.stderr)
+        print("""Usage:
+  upload_tiktok.py --auth              # Authorize (first time)
+  upload_tiktok.py --refresh            # Refresh token
+  upload_tiktok.py <video.mp4> [title]  # Upload video
+  upload_tiktok.py --manifest <file>    # Upload from manifest
+  Add --pretty to indent the JSON result""", file=sys.stderr)
         sys.exit(1)
 
     if sys.argv[1] == "--auth":
@@ -362,9 +491,9 @@ if __name__ == "__main__":
             if idx + 1 < len(sys.argv):
                 max_up = int(sys.argv[idx + 1])
         result = upload_from_manifest(manifest_file, max_uploads=max_up)
-        print(json.dumps(result, indent=2))
+        print(json.dumps(result, indent=indent))
     else:
         video = sys.argv[1]
         title = sys.argv[2] if len(sys.argv) > 2 else "Story Time"
         result = upload_short(video, title)
-        print(json.dumps(result, indent=2))
+        print(json.dumps(result, indent=indent))
@@ -0,0 +1,100 @@
+import http.client
+import http.server
+import os
+import sys
+import threading
+import time
+import unittest
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import http_utils
+from http_utils import open_url
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with server.lock:
+            server.seen.append((self.command, body))
+            server.peers.append(self.client_address)
+            action = server.actions.pop(0) if server.actions else "ok"
+        if action == "drop":
+            # Read the request, then hang up without replying
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+        self.wfile.flush()
+        if action == "ok-close":
+            # Reply as keep-alive, then close the idle connection anyway
+            self.close_connection = True
+
+    do_GET = do_POST = _handle
+
+
+class OpenUrlResendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.seen = []
+        self.server.peers = []
+        self.server.actions = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        # Each test starts without connections left over from another one
+        http_utils._local.conns = {}
+
+    def tearDown(self):
+        for conn in http_utils._local.conns.values():
+            conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _call(self, method, fresh=False):
+        data = b"x=1" if method == "POST" else None
+        req = urllib.request.Request(self.url, data=data, method=method)
+        with open_url(req, fresh=fresh) as resp:
+            return resp.read()
+
+    def test_post_is_not_resent_when_the_reply_is_lost(self):
+        self.server.actions = ["ok", "drop"]
+        self.assertEqual(self._call("POST"), b"ok")
+        with self.assertRaises((http.client.HTTPException, ConnectionError)):
+            self._call("POST")
+        self.assertEqual([m for m, _ in self.server.seen], ["POST", "POST"])
+
+    def test_get_is_resent_when_the_reply_is_lost(self):
+        self.server.actions = ["ok", "drop"]
+        self.assertEqual(self._call("GET"), b"ok")
+        self.assertEqual(self._call("GET"), b"ok")
+        self.assertEqual([m for m, _ in self.server.seen], ["GET", "GET", "GET"])
+
+    def test_post_after_server_closed_idle_connection_reconnects(self):
+        self.server.actions = ["ok-close"]
+        self.assertEqual(self._call("POST"), b"ok")
+        time.sleep(0.2)  # let the server's FIN arrive
+        self.assertEqual(self._call("POST"), b"ok")
+        self.assertEqual([m for m, _ in self.server.seen], ["POST", "POST"])
+
+    def test_fresh_post_uses_a_new_connection(self):
+        self._call("GET")
+        self._call("GET")
+        self._call("POST", fresh=True)
+        first, reused, fresh = self.server.peers
+        self.assertEqual(first, reused)
+        self.assertNotEqual(reused, fresh)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from upload_tiktok import CHUNK_SIZE, CHUNKED_MIN, chunk_ranges
+
+MB = 1024 * 1024
+
+
+class ChunkRangesTest(unittest.TestCase):
+    def assert_covers(self, file_size, chunk_size, ranges):
+        """Ranges are contiguous, start at 0 and end on the last byte."""
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], file_size - 1)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(start, end + 1)
+        # Every chunk but the last is exactly chunk_size
+        for start, end in ranges[:-1]:
+            self.assertEqual(end - start + 1, chunk_size)
+
+    def test_small_file_is_one_whole_chunk(self):
+        for size in (1, 5 * MB, int(8.5 * MB), int(9.9 * MB), CHUNK_SIZE, CHUNKED_MIN - 1):
+            with self.subTest(size=size):
+                chunk_size, ranges = chunk_ranges(size)
+                self.assertEqual(chunk_size, size)
+                self.assertEqual(ranges, [(0, size - 1)])
+
+    def test_large_file_is_chunked(self):
+        for size in (CHUNKED_MIN, 25 * MB, 64 * MB + 123):
+            with self.subTest(size=size):
+                chunk_size, ranges = chunk_ranges(size)
+                self.assertEqual(chunk_size, CHUNK_SIZE)
+                self.assertEqual(len(ranges), size // CHUNK_SIZE)
+                self.assert_covers(size, chunk_size, ranges)
+
+    def test_last_chunk_absorbs_remainder(self):
+        chunk_size, ranges = chunk_ranges(25 * MB)
+        self.assertEqual(len(ranges), 2)
+        start, end = ranges[-1]
+        self.assertEqual(end - start + 1, 15 * MB)
+        self.assertLess(end - start + 1, 2 * chunk_size)
+
+
+if __name__ == "__main__":
+    unittest.main()